@@ -0,0 +1,201 @@
+# #############################################################################
+# edfi cli benchmarks
+#
+# runs edfi.py against the local mock server (mockserver.py) in each fetch
+# mode - serial, threads, asyncio - and for count, and reports records per
+# second, page latency, peak memory and the requests the server saw.  Each run
+# is a separate process with its own config and cold caches
+#
+# run python3 bench.py --help to see usage
+#
+# #############################################################################
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import toml
+
+import mockserver
+
+EDFI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edfi.py")
+
+MODES = {
+    "serial": {"async_requests": False},
+    "threads": {"async_requests": True, "async_engine": "threads"},
+    "asyncio": {"async_requests": True, "async_engine": "asyncio"},
+    "count": {"async_requests": True},
+}
+
+API_VERSIONS = {"v2": "v2.0", "v3": "v3.1"}
+
+def quantile(values, q):
+    """ exact quantile of a list of values """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_edfi(args, cwd):
+    """ runs edfi.py in cwd - returns (exit code, seconds, peak rss in MB or None) """
+    start = time.time()
+    with open(os.path.join(cwd, "stdout.txt"), "w") as out:
+        process = subprocess.Popen([sys.executable, EDFI] + args, cwd=cwd, stdout=out, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            # the rusage of this child only - RUSAGE_CHILDREN would be the max over every run
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+            rss = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+        else:
+            process.wait()
+            rss = None
+    return process.returncode, time.time() - start, rss
+
+def read_profile(filename):
+    """ durations of the GET entries in a json profile log """
+    durations = []
+    if not os.path.exists(filename):
+        return durations
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('message', '').startswith("GET"):
+                durations.append(entry['duration'])
+    return durations
+
+def bench(server, api, mode, workers, endpoint, limit):
+    """ one run of edfi.py in a new directory - returns the result row """
+    general = dict(MODES[mode], max_workers=workers, async_concurrency=workers, profile_logging=True, logging_format="json",
+                   metrics_file="metrics.json", metrics_interval=0)
+    customer = {"edfi_client_id": "bench", "edfi_client_secret": "bench", "edfi_base_url": server.url, "api_ver": API_VERSIONS[api]}
+    cwd = tempfile.mkdtemp(prefix="edfi-bench-")
+    try:
+        with open(os.path.join(cwd, "config.toml"), "w") as f:
+            toml.dump({"general": general, "bench": customer}, f)
+        if mode == "count":
+            args = ["count", endpoint, "bench", "2018"]
+        else:
+            args = ["get", endpoint, "bench", "2018", "--page=-1", "--limit=%d" % limit, "--output=out.json", "--format=ndjson"]
+        server.reset()
+        code, seconds, rss = run_edfi(args, cwd)
+        requests = server.reset()
+
+        records = 0
+        if mode == "count":
+            with open(os.path.join(cwd, "stdout.txt")) as f:
+                output = f.read()
+            ok = code == 0 and "%s - %d" % (endpoint, server.endpoints[endpoint]) in output
+        else:
+            if os.path.exists(os.path.join(cwd, "out.json")):
+                with open(os.path.join(cwd, "out.json")) as f:
+                    records = sum(1 for line in f if line.strip())
+            ok = code == 0 and records == server.endpoints[endpoint]
+        durations = read_profile(os.path.join(cwd, "profile.log"))
+        metrics = {}
+        if os.path.exists(os.path.join(cwd, "metrics.json")):
+            with open(os.path.join(cwd, "metrics.json")) as f:
+                metrics = json.load(f)
+        return {
+            "api": api,
+            "mode": mode,
+            "workers": workers,
+            "ok": ok,
+            "seconds": round(seconds, 3),
+            "records": records,
+            "records_per_second": round(records / seconds, 1) if seconds else 0,
+            "p50": quantile(durations, 0.5),
+            "p99": quantile(durations, 0.99),
+            "peak_rss_mb": round(rss, 1) if rss is not None else None,
+            "requests": requests.get('data', 0) + requests.get('metadata', 0) + requests.get('unauthorized', 0) + requests.get('errors', 0),
+            "auth": requests.get('auth', 0),
+            "unauthorized": requests.get('unauthorized', 0),
+            "errors": requests.get('errors', 0),
+            "retries": metrics.get('counters', {}).get('retries'),
+            "wire_mb": round(metrics['counters']['wire_bytes'] / 1e6, 2) if 'wire_bytes' in metrics.get('counters', {}) else None,
+        }
+    finally:
+        shutil.rmtree(cwd, ignore_errors=True)
+
+COLUMNS = ["api", "mode", "workers", "ok", "seconds", "records_per_second", "p50", "p99", "peak_rss_mb", "requests", "auth", "unauthorized", "errors", "retries", "wire_mb"]
+
+def echo_row(row, baseline=None):
+    """ prints a result row - with the change in records/s from the baseline run of the same api, mode and workers """
+    cells = ["-" if row.get(c) is None else ("%.4f" % row[c] if c in ("p50", "p99") else str(row[c])) for c in COLUMNS]
+    line = "  ".join(cell.rjust(max(len(c), 7)) for c, cell in zip(COLUMNS, cells))
+    if baseline:
+        for base in baseline:
+            if (base['api'], base['mode'], base['workers']) == (row['api'], row['mode'], row['workers']) and base.get('records_per_second'):
+                line += "  %+.1f%%" % (100.0 * (row['records_per_second'] - base['records_per_second']) / base['records_per_second'])
+    click.echo(line)
+
+def split_list(value, cast=str):
+    """ comma separated option to a list """
+    return [cast(x.strip()) for x in value.split(",") if x.strip()]
+
+@click.command()
+@click.option("--records", default=10000, help="records served for the benchmarked endpoint")
+@click.option("--limit", default=100, help="page size")
+@click.option("--api", default="v2,v3", help="api versions to run, comma separated (v2, v3)")
+@click.option("--modes", default="serial,threads,asyncio,count", help="fetch modes to run, comma separated (%s)" % ", ".join(MODES))
+@click.option("--workers", default="4,8,16", help="max_workers (async_concurrency for asyncio) to run, comma separated")
+@click.option("--latency", default=0.02, help="seconds the server adds to each data request")
+@click.option("--jitter", default=0.01, help="up to this many more seconds added at random")
+@click.option("--error-rate", default=0.0, help="fraction of data requests answered with a 429 or 503")
+@click.option("--token-ttl", default=0.0, help="seconds after which the server refuses tokens (401) - 0 never")
+@click.option("--repeat", default=1, help="runs of each combination")
+@click.option("--seed", default=1, help="seed for the server's jitter and errors")
+@click.option("--gzip", "use_gzip", is_flag=True, help="have the server gzip its responses")
+@click.option("--output", default=None, type=click.Path(), help="write the results as json to this file")
+@click.option("--baseline", default=None, type=click.Path(exists=True), help="results of an earlier run (--output) to compare records/s with")
+def cli(records, limit, api, modes, workers, latency, jitter, error_rate, token_ttl, repeat, seed, use_gzip, output, baseline):
+    """ benchmarks the fetch modes of edfi.py against the mock server """
+    modes = split_list(modes)
+    for mode in modes:
+        if mode not in MODES:
+            raise click.BadParameter("unknown mode %s" % mode, param_hint="--modes")
+        if mode == "asyncio":
+            try:
+                import aiohttp # only to check it is there for edfi.py
+            except ImportError:
+                raise click.BadParameter("asyncio requires aiohttp - pip3 install aiohttp", param_hint="--modes")
+    apis = split_list(api)
+    for version in apis:
+        if version not in API_VERSIONS:
+            raise click.BadParameter("unknown api %s" % version, param_hint="--api")
+    base = None
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)
+
+    endpoint = "students"
+    server = mockserver.start(endpoints={endpoint: records}, latency=latency, jitter=jitter, error_rate=error_rate, token_ttl=token_ttl, seed=seed, gzip=use_gzip)
+    click.echo("mock server %s - %d records, page size %d, latency %.3fs + %.3fs jitter, error rate %.3f, token ttl %s%s" % (
+        server.url, records, limit, latency, jitter, error_rate, token_ttl or "-", ", gzip" if use_gzip else ""))
+    click.echo("  ".join(c.rjust(max(len(c), 7)) for c in COLUMNS))
+    results = []
+    try:
+        for version in apis:
+            for mode in modes:
+                for count in split_list(workers, int):
+                    for i in range(repeat):
+                        row = bench(server, version, mode, count, endpoint, limit)
+                        results.append(row)
+                        echo_row(row, base)
+    finally:
+        server.shutdown()
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+    if not all(row['ok'] for row in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
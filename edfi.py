@@ -9,28 +9,167 @@
 # Must create config.toml with credentials to one or more endpoints - see
 #   config.template for an example, copy and alter to environment
 #
-# NOTE: this does not utilize the "change set" feature found in EdFi v3.x
-# releases (at this time)
+# NOTE: the "sync" command uses the change queries feature found in EdFi v3.x
+# releases, all other commands read the full data set
+#
+# When "python3 edfi.py serve" is running, commands are forwarded to it over a
+# unix socket and run on its warm clients - see forward_to_server
 #
 # #############################################################################
+import os
+import socket
+import struct
+import sys
+
+import stat
+
+SOCKET_PATH = os.environ.get("EDFI_SOCKET") or os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "edfi-{}".format(os.getuid() if hasattr(os, "getuid") else 0), "edfi.sock")
+
+def private_path(path, kind=stat.S_IFSOCK):
+    """ true if path is a kind (socket, folder) owned by this user that no one else may use """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_IFMT(st.st_mode) == kind and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+def peer_uid(conn):
+    """ the user id of the process at the other end of a unix socket - None where it can not be told """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+def reads_stdin(argv):
+    """ true if the command line reads stdin - getrecords without --ids or with --ids=- """
+    if not argv or argv[0] != "getrecords":
+        return False
+    for i, arg in enumerate(argv):
+        if arg == "--ids":
+            return i + 1 < len(argv) and argv[i + 1] == "-"
+        if arg.startswith("--ids="):
+            return arg == "--ids=-"
+    return True
+
+def forward_to_server(argv):
+    """
+    runs the command on the serve daemon if one is listening on SOCKET_PATH -
+    returns the exit code, or None if there is no server or the command reads
+    stdin (it then runs in this process, streaming its input).  Only a socket
+    of this user's, that no one else can use, is trusted with the command.  Only
+    needs the standard library, so it runs before click, requests and the rest are imported
+    """
+    if reads_stdin(argv) or not hasattr(socket, "AF_UNIX") or not os.path.exists(SOCKET_PATH):
+        return None
+    if not private_path(SOCKET_PATH):
+        sys.stderr.write("ignoring %s - not a socket of this user's only\n" % SOCKET_PATH)
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(SOCKET_PATH)
+        if peer_uid(conn) not in (None, os.getuid()):
+            conn.close()
+            sys.stderr.write("ignoring %s - served by another user\n" % SOCKET_PATH)
+            return None
+    except OSError:
+        conn.close()
+        return None # stale socket file
+    import json
+    request = {"argv": argv, "cwd": os.getcwd(), "color": sys.stdout.isatty()}
+    conn.sendall(json.dumps(request).encode() + b"\n")
+    reader = conn.makefile("rb")
+    streams = {b"o": sys.stdout.buffer, b"e": sys.stderr.buffer}
+    try:
+        while True:
+            header = reader.read(5)
+            if len(header) < 5:
+                sys.stderr.write("edfi server closed the connection\n")
+                return 1
+            channel, length = header[:1], struct.unpack(">I", header[1:])[0]
+            payload = reader.read(length)
+            if channel == b"x":
+                return int(payload)
+            streams[channel].write(payload)
+            streams[channel].flush()
+    except BrokenPipeError:
+        return 1 # our reader went away (e.g. | head) - closing makes the server stop the command
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        conn.close()
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] != "serve" and not os.environ.get("EDFI_NO_SERVER"):
+    code = forward_to_server(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
+import asyncio
+import atexit
+from bisect import bisect_left
+import bz2
+import copy
+import csv
+import gzip
+import hashlib
 import inspect
+import io
 import json
 import logging
-import os
-from queue import Queue
-import sys
-from threading import Thread
+from logging.handlers import QueueHandler, QueueListener
+import lzma
+import random
+import shutil
+import sqlite3
+from queue import Full, Queue
+from threading import Condition, Event, Lock, Thread
 import time
+import zlib
+
+from collections import deque
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlencode, urlparse
 
 import click
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import toml
 
+try:
+    import aiohttp # optional - only needed for async_engine = "asyncio"
+except ImportError:
+    aiohttp = None
+try:
+    import pyarrow # optional - only needed for --format=parquet
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard # optional - only needed for .zst files and --compress=zstd
+except ImportError:
+    zstandard = None
+try:
+    import fcntl # not available on windows - the token cache is then locked per process only
+except ImportError:
+    fcntl = None
+
 __version__ = "0.0.1"
 
 logging.captureWarnings(True)
 
+RETRY_STATUSES = (429, 500, 502, 503, 504) # retried with backoff, the others fail straight away
+# connection errors and bodies cut short or garbled on the way - retried like RETRY_STATUSES
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ContentDecodingError)
+class AuthError(click.ClickException):
+    """ no token could be had from the api - click exits with 1 """
+
+COUNT_PROBES = 8 # most offsets probed at once when an endpoint is counted without Total-Count
+COUNT_PROBE_MAX = 10 ** 9 # the probed offsets stop growing here
+
 class Config(object):
     """
     Manages config files
@@ -58,12 +197,20 @@ class EdFi(object):
     headers = {"Content-Type": "application/json"}
     profilelogger = None
     verify_ssl = True
+    session = None
+    page_cache = None
+    page_cache_mode = None # set by caching() for the commands that use the page cache
+    _schema_index = None # (SchemaIndex, swagger 'downloaded' it was built from, when it was last checked)
+    _metrics_started = False
 
     def __init__(self, year:str, customer_id:str):
         """ inity stuff """
         self.customer_id = customer_id
         self.year = year
         self.cfg = Config().config
+        self.headers = dict(self.headers) # per instance, the auth token is added to these
+        self.auth_lock = Lock()
+        self.auth_state = {"expires_at": None, "margin": None} # shared with for_year copies, as are headers and the lock
 
         if customer_id not in self.cfg:
             echo("Customer '%s' not found in config" % customer_id, FAIL)
@@ -92,34 +239,292 @@ class EdFi(object):
         #   curl https://api.ed-fi.org/api/oauth/token -H "Content-Type: application/json" -d "{'Client_id':'<clientid>','Client_secret':'<client secret>','Code':'R3PLAC3_W1TH_AUTH_COD3','Grant_type':'authorization_code'}"
         #   ^^^ returns: {"access_token": "<token<", "expires_in": 22199, "token_type": "bearer"}
 
-        self.get_auth_token()
+        self.session = self.build_session()
+        self.throttle = self.build_throttle()
+        self.rate_limiter = None
+        if self.cfg[customer_id].get('max_requests_per_second'):
+            self.rate_limiter = RateLimiter(float(self.cfg[customer_id]['max_requests_per_second']))
+        # the token is fetched on first use (see ensure_auth_token) - commands served
+        # from the metadata cache never authenticate
+
+        self.token_cache = None
+        if self.general_setting('token_cache', True):
+            self.token_cache = TokenCache(self.general_setting('cache_dir', '.edfi_cache'), customer_id, self.baseurl, self.cfg[customer_id]['edfi_client_id'])
+
+        self.metadata_cache = None
+        if self.general_setting('metadata_cache', True):
+            self.metadata_cache = MetadataCache(self.general_setting('cache_dir', '.edfi_cache'), customer_id, self.baseurl, self.api_ver)
+
+        if self.general_setting('page_cache', False):
+            size = 256
+            try:
+                size = float(self.general_setting('page_cache_size', size))
+            except:
+                pass
+            self.page_cache = PageCache(os.path.join(self.general_setting('cache_dir', '.edfi_cache'), "pages.sqlite"), int(size * 1024 * 1024))
 
         # setup profiler if needed
         if "general" in self.cfg and "profile_logging" in self.cfg['general'] and self.cfg['general']['profile_logging']:
             self.profilelogger = logging.getLogger('profile')
+        if self.profilelogger and not self.profilelogger.handlers:
+            # set up once per process - every instance logs to the same file
             self.profilelogger.setLevel(logging.INFO)
+            self.profilelogger.propagate = False
             logfilename = 'profile.log'
             formatter = logging.Formatter("%(asctime)s dur:%(duration)s - %(message)s") # default formatter
             if 'logging_format' in self.cfg['general'] and self.cfg['general']['logging_format'] == "json":
-                # brute force json logging format - but it works
-                formatter = logging.Formatter('{"datetime":"%(asctime)s","duration":%(duration)s,"message":"%(message)s"}')
+                formatter = JsonFormatter()
             fh = logging.FileHandler(logfilename)
             fh.setFormatter(formatter)
-            self.profilelogger.addHandler(fh)
+            # the workers only queue the entries, formatting and writing happen on the listener's thread
+            log_queue = Queue()
+            self.profilelogger.addHandler(QueueHandler(log_queue))
+            listener = QueueListener(log_queue, fh)
+            listener.start()
+            atexit.register(listener.stop)
             echo("Profile logging enabled - writing to " + logfilename, INFO)
 
+        self.metrics = Metrics({"customer": customer_id, "year": year})
+        if self.general_setting('metrics_file') and not EdFi._metrics_started:
+            EdFi._metrics_started = True # one writer per process, it writes the metrics of every instance
+            self.start_metrics()
+
+    def for_year(self, year):
+        """
+        an instance for another year of the same customer - the token (headers,
+        expiry and lock), session, throttle and caches are shared, so the
+        customer's years use one token between them
+        """
+        edfi = copy.copy(self)
+        edfi.year = year
+        edfi.metrics = Metrics({"customer": self.customer_id, "year": year})
+        return edfi
+
+    def close(self):
+        """ closes the session and page cache (shared with for_year copies) and drops the metrics """
+        self.metrics.unregister()
+        self.session.close()
+        if self.page_cache:
+            self.page_cache.close()
+
+    @property
+    def token_expires_at(self):
+        """ when the token expires (epoch seconds) - None if it did not say """
+        return self.auth_state['expires_at']
+
+    @token_expires_at.setter
+    def token_expires_at(self, value):
+        self.auth_state['expires_at'] = value
+
+    def general_setting(self, name, default=None):
+        """ returns a setting from the [general] section of the config """
+        if 'general' in self.cfg and name in self.cfg['general']:
+            return self.cfg['general'][name]
+        return default
+
+    @property
+    def max_workers(self):
+        """ number of workers - if not set, use 5x processors of host as count - https://docs.python.org/3/library/concurrent.futures.html """
+        try:
+            return max(1, int(self.general_setting('max_workers')))
+        except:
+            return (os.cpu_count() or 1) * 5
+
+    @property
+    def host_concurrency(self):
+        """ requests in flight to the api host, over all customers of a fanout run - defaults to max_workers """
+        for section in [self.cfg[self.customer_id], self.cfg.get('general', {})]:
+            try:
+                return max(1, int(section['host_concurrency']))
+            except:
+                pass
+        return self.max_workers
+
+    def build_session(self):
+        """
+        builds the connection pooled session used for all calls to the api
+
+        the session is shared by all worker threads - connections are kept alive
+        and reused between pages instead of a new tcp/tls handshake per request.
+        pool_maxsize is the per host connection limit and defaults to max_workers,
+        pool_block makes workers wait for a free connection rather than opening
+        more than that
+        """
+        pool_maxsize = self.max_workers
+        try:
+            pool_maxsize = max(1, int(self.general_setting('max_connections_per_host', pool_maxsize)))
+        except:
+            pass
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize, pool_block=True)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers['Accept-Encoding'] = self.accept_encoding # bodies are decompressed as they are read
+        return session
+
+    @property
+    def accept_encoding(self):
+        """ the encodings asked of the api - accept_encoding, gzip and deflate by default ("identity" for none) """
+        return self.general_setting('accept_encoding', "gzip, deflate")
+
+    def build_throttle(self):
+        """
+        builds the controller for the number of requests in flight - at most
+        max_workers (async_concurrency for the asyncio engine), adjusted to the
+        latency and errors seen unless adaptive_concurrency is false
+        """
+        max_limit = self.max_workers
+        if self.general_setting('async_engine') == "asyncio":
+            try:
+                max_limit = max(1, int(self.general_setting('async_concurrency', 100)))
+            except:
+                max_limit = 100
+        if not self.general_setting('adaptive_concurrency', True):
+            return ConcurrencyController(max_limit, min_limit=max_limit)
+        return ConcurrencyController(max_limit)
+
+    def connection_stats(self):
+        """ returns the number of requests and connections (handshakes) made by the session """
+        stats = {"requests": 0, "connections": 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['handshakes_saved'] = max(0, stats['requests'] - stats['connections'])
+        return stats
+
+    def profile_connections(self):
+        """ logs the connection reuse of the session """
+        if not self.profilelogger:
+            return
+        stats = self.connection_stats()
+        self.profile("connections (requests: %d, handshakes: %d, handshakes saved: %d)" % (
+            stats['requests'], stats['connections'], stats['handshakes_saved']), 0)
+
+    def start_metrics(self):
+        """
+        writes the metrics snapshot to metrics_file every metrics_interval
+        seconds (default 60) and once more at exit
+        """
+        interval = 60.0
+        try:
+            interval = float(self.general_setting('metrics_interval', interval))
+        except:
+            pass
+        stop = Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.write_metrics()
+
+        def finish():
+            stop.set()
+            self.write_metrics()
+        if interval > 0:
+            Thread(target=run, daemon=True).start()
+        atexit.register(finish)
+
+    def write_metrics(self, filename=None):
+        """
+        writes the metrics snapshot of every instance in the process -
+        prometheus text if the file name ends with .prom, else json (a list if
+        there is more than one customer/year).  Written to a temporary file
+        and renamed so readers never see a partial snapshot
+        """
+        filename = filename or self.general_setting('metrics_file')
+        metrics = Metrics.all()
+        if filename.endswith(".prom"):
+            content = Metrics.exposition(metrics)
+        elif len(metrics) == 1:
+            content = json.dumps(metrics[0].snapshot(), indent=4)
+        else:
+            content = json.dumps([m.snapshot() for m in metrics], indent=4)
+        try:
+            with open(filename + ".tmp", 'w') as f:
+                f.write(content)
+            os.replace(filename + ".tmp", filename)
+        except OSError as exp:
+            echo("Could not write metrics to %s - %s" % (filename, exp), FAIL)
+
+    def token_expiring(self):
+        """ true if there is no token or it expires within token_refresh_margin seconds """
+        if "Authorization" not in self.headers:
+            return True
+        if not self.token_expires_at:
+            return False
+        margin = self.auth_state['margin']
+        if margin is None:
+            margin = self.token_refresh_margin()
+        return time.time() >= self.token_expires_at - margin
+
+    def token_refresh_margin(self, expires_in=None):
+        """
+        seconds before expiry a token is refreshed - at most half of its
+        lifetime, so short lived tokens are not refreshed on every request
+        """
+        margin = 60
+        try:
+            margin = float(self.general_setting('token_refresh_margin', margin))
+        except:
+            pass
+        if expires_in:
+            margin = min(margin, float(expires_in) / 2)
+        return margin
+
+    def ensure_auth_token(self):
+        """ gets a token if there is none yet, or refreshes it before it expires """
+        if self.token_expiring():
+            self.refresh_auth_token(self.headers.get("Authorization"))
+
+    def refresh_auth_token(self, stale=None):
+        """
+        single flight token refresh - stale is the Authorization header the caller
+        used.  Only one thread refreshes, the others wait on the lock and then find
+        the token already replaced.  The token cache is checked (under a file lock)
+        before going to the api so processes share the token as well
+        """
+        with self.auth_lock:
+            if self.headers.get("Authorization") != stale and not self.token_expiring():
+                return # refreshed while we waited
+            if not self.token_cache:
+                self.metrics.add(token_refreshes=1)
+                self.get_auth_token()
+                return
+            self.metrics.add(token_refreshes=1)
+            with self.token_cache.lock():
+                cached = self.token_cache.load()
+                if cached and "Bearer {}".format(cached['access_token']) != stale:
+                    self.headers.update({"Authorization":  "Bearer {}".format(cached['access_token'])})
+                    self.token_expires_at = cached['expires_at']
+                    self.auth_state['margin'] = cached.get('margin')
+                    if not self.token_expiring():
+                        return
+                self.get_auth_token()
+                self.token_cache.save(self.headers["Authorization"][len("Bearer "):], self.token_expires_at, self.auth_state['margin'])
+
+    def set_auth_token(self, token_data):
+        """ sets the token from an oauth token response """
+        self.headers.update({"Authorization":  "Bearer {}".format(token_data['access_token'])})
+        self.token_expires_at = None
+        self.auth_state['margin'] = None
+        if token_data.get('expires_in'):
+            self.token_expires_at = time.time() + float(token_data['expires_in'])
+            self.auth_state['margin'] = self.token_refresh_margin(token_data['expires_in'])
+
     def get_auth_token(self):
         # get token based on version
         if self.api_ver.startswith("v3."):
             ## v3 token process
             url = "{}/api/oauth/token".format(self.baseurl)
             auth = HTTPBasicAuth(self.cfg[self.customer_id]["edfi_client_id"],self.cfg[self.customer_id]["edfi_client_secret"])
+            res = None
             try:
-                res = requests.post(url, json={"grant_type":"client_credentials"}, verify=False, auth=auth)
-                self.headers.update({"Authorization":  "Bearer {}".format(res.json()['access_token'])})
+                res = self.session.post(url, json={"grant_type":"client_credentials"}, verify=False, auth=auth)
+                self.set_auth_token(res.json())
             except Exception as exp:
-                echo("Could not authenticate to 3.x api instance %s - %s" % (exp, res.content), FAIL)
-                sys.exit(1)
+                raise AuthError("Could not authenticate to 3.x api instance %s%s" % (exp, " - %s" % res.content if res is not None else ""))
 
         else:
             # default to 2.x
@@ -127,15 +532,14 @@ class EdFi(object):
             data = {"Client_id": self.cfg[self.customer_id]["edfi_client_id"], "Response_type": "code"}
             auth_code = None
             try:
-                res = requests.post(url, json=data, verify=self.verify_ssl)
+                res = self.session.post(url, json=data, verify=self.verify_ssl)
                 if res.status_code > 399:
                     raise Exception("HTTP error - {} on authorize to {} - {}".format(res.status_code, url, res.content))
                 if "error" in res.json() and res.json()['error']:
                     raise Exception("EDFI Authorize error on {} - {}".format(url, res.json()['error']))
                 auth_code = res.json()['code']
             except Exception as exp:
-                echo(exp, FAIL)
-                sys.exit(1)
+                raise AuthError(str(exp))
         
             url = "{}/oauth/token".format(self.baseurl)
             data = {
@@ -145,21 +549,28 @@ class EdFi(object):
                 'Grant_type':'authorization_code'
             }
             try:
-                res = requests.post(url, json=data, headers={"Content-Type": "application/json"}, verify=self.verify_ssl)
+                res = self.session.post(url, json=data, headers={"Content-Type": "application/json"}, verify=self.verify_ssl)
                 if res.status_code > 399:
                     raise Exception("HTTP error - {} on authenticate to {} - {}".format(res.status_code, url, res.content))
-                self.headers.update({"Authorization":  "Bearer {}".format(res.json()['access_token'])})
+                self.set_auth_token(res.json())
             except Exception as exp:
-                echo(exp, FAIL)
-                sys.exit(1)
+                raise AuthError(str(exp))
 
         
   
-    def profile(self, description, duration):
-        """ logs profiling information """
+    def profile(self, description, duration, **fields):
+        """ logs profiling information - fields are written as well by the json format """
         if not self.profilelogger:
             return
-        self.profilelogger.info(description, extra={"duration":duration})
+        fields['duration'] = duration
+        self.profilelogger.info(description, extra=fields)
+
+    def record(self, description, stats):
+        """ adds a request's stats to the metrics and logs them """
+        self.metrics.observe(**stats)
+        if self.profilelogger:
+            fields = dict(stats)
+            self.profile(description, fields.pop('duration', 0), **fields)
 
     def __build_url(self, endpoint):
         """ url builder """
@@ -185,37 +596,195 @@ class EdFi(object):
         raise Exception("Could not determine version in order to build url")
 
 
-    def worker_get(self, url, offset, limit):
-        """ performs the get """
-        _url = "{}?offset={}&limit={}".format(url, offset, limit)
+    def retry_delay(self, attempt, retry_after=None):
+        """
+        seconds to wait before retry number attempt - the server's Retry-After
+        if it sent one, else exponential backoff with full jitter
+        """
+        cap = 30.0
+        try:
+            cap = float(self.general_setting('backoff_max', cap))
+        except:
+            pass
+        if retry_after:
+            try:
+                return min(cap, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(cap, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+                except Exception:
+                    pass
+        base = 0.5
+        try:
+            base = float(self.general_setting('backoff_base', base))
+        except:
+            pass
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+    @property
+    def max_retries(self):
+        """ number of attempts for a request """
+        try:
+            return max(1, int(self.general_setting('max_retries', 5)))
+        except:
+            return 5
+
+    @contextmanager
+    def caching(self, no_cache=False, refresh=False):
+        """
+        serves the pages, records and counts requested in the block from the
+        page cache (when page_cache is set) and caches what is fetched -
+        refresh fetches everything again and updates the cache, no_cache
+        neither reads nor writes it
+        """
+        mode = None if no_cache or not self.page_cache else ("refresh" if refresh else "use")
+        previous, self.page_cache_mode = self.page_cache_mode, mode
+        try:
+            yield
+        finally:
+            self.page_cache_mode = previous
+
+    def page_cache_ttl(self, url):
+        """
+        seconds a response of url is served from the page cache - the
+        endpoint's page_cache_ttls entry, else page_cache_ttl (default 300)
+        """
+        parts = url[len(self.baseurl):].split("?")[0].strip("/").split("/")
+        endpoint = parts[4] if self.api_ver.startswith("v3.") and len(parts) > 4 else parts[3] if len(parts) > 3 else None
+        ttls = self.general_setting('page_cache_ttls', {})
+        try:
+            return float(ttls[endpoint] if endpoint in ttls else self.general_setting('page_cache_ttl', 300))
+        except:
+            return 300.0
+
+    def cache_load(self, url):
+        """ the cached (status, headers, body) of url - None when not cached, expired or the cache is not in use """
+        if self.page_cache_mode != "use":
+            return None
+        ttl = self.page_cache_ttl(url)
+        return self.page_cache.load(self.customer_id, url, ttl) if ttl > 0 else None
+
+    def cache_save(self, url, status, headers, body):
+        """ caches a response of url - when the cache is in use and the endpoint has a ttl """
+        if self.page_cache_mode and self.page_cache_ttl(url) > 0:
+            self.page_cache.save(self.customer_id, url, status, headers, body)
+
+    def worker_request(self, _url, headers=None, stats=None, accept=(), cache=False):
+        """
+        performs the get, refreshing the token on a 401 and retrying 429/5xx and
+        connection errors with backoff - returns the response, raises once the retries are used up
+        """
+        # duration, ttfb, bytes (decoded), wire_bytes (compressed), retries, refreshes
+        # and throttle_wait go to stats - recorded here unless the caller passed stats
+        own = stats is None
+        stats = {} if own else stats
+        stats.update(retries=0, refreshes=0, throttle_wait=0.0)
+        if cache: # the page cache, see caching()
+            start = time.time()
+            entry = self.cache_load(_url)
+            if entry:
+                stats.update(duration=time.time() - start, ttfb=0.0, bytes=len(entry[2]), cache_hits=1)
+                if own:
+                    self.record("GET "+_url, stats)
+                return cached_response(_url, entry)
+        self.ensure_auth_token()
         retries = 0
-        data = []
-        while retries < 5:
+        res = None
+        while retries < self.max_retries:
             retries += 1
             try:
-                res = requests.get(_url, headers=self.headers, verify=self.verify_ssl)
+                _headers = dict(self.headers, **(headers or {}))
+                start = time.time()
+                if self.rate_limiter:
+                    time.sleep(self.rate_limiter.reserve())
+                self.throttle.acquire()
+                stats['throttle_wait'] += time.time() - start
+                start = time.time()
+                res = failed = None
+                try:
+                    res = self.session.get(_url, headers=_headers, verify=self.verify_ssl)
+                except RETRY_ERRORS as exp:
+                    failed = exp
+                finally:
+                    # whatever get raised, the slot goes back before any backoff
+                    duration = time.time() - start
+                    self.throttle.release(duration, ok=res is not None and res.status_code not in RETRY_STATUSES)
+                if failed is not None:
+                    if retries < self.max_retries:
+                        stats['retries'] += 1
+                        time.sleep(self.retry_delay(retries))
+                        continue
+                    raise failed
                 if res.status_code == 401:
-                    self.get_auth_token()
-                    time.sleep(1)
+                    stats['refreshes'] += 1
+                    self.refresh_auth_token(_headers.get("Authorization"))
+                    continue
+                if res.status_code in RETRY_STATUSES and retries < self.max_retries:
+                    stats['retries'] += 1
+                    time.sleep(self.retry_delay(retries, res.headers.get('Retry-After')))
                     continue
 
+                # elapsed stops when the headers are parsed - the rest of duration is the body
+                stats.update(duration=duration, ttfb=res.elapsed.total_seconds(), bytes=len(res.content),
+                             wire_bytes=res.raw.tell() if res.raw is not None else len(res.content))
+                if cache and (res.status_code < 300 or res.status_code in accept):
+                    self.cache_save(_url, res.status_code, res.headers, res.content)
+                # a 304 only answers conditional headers, statuses in accept (e.g. 404) are returned not raised
+                if (res.status_code == 304 and headers) or res.status_code in accept:
+                    if own:
+                        self.record("GET "+_url, stats)
+                    return res
                 if res.status_code > 299:
-                    echo("error on url: {}".format(url), FAIL)
+                    echo("error on url: {}".format(_url), FAIL, err=True)
                     raise Exception("HTTP error - {} on get to {} - {}".format(res.status_code, _url, res.content))
-                self.profile("GET "+_url, res.elapsed.total_seconds())
-                data = res.json()
-                break
+                if own:
+                    self.record("GET "+_url, stats)
+                return res
             except Exception as exp:
-                msg = "Could not get data from %s - %s" % (_url, res.content)
-                print(msg)
+                self.metrics.add(errors=1)
+                msg = "Could not get data from %s - %s" % (_url, res.content if res is not None else exp)
+                echo(msg, FAIL, err=True)
                 raise Exception(msg)
+        # every attempt was refused (401) - fail like the other engines rather than look empty
+        self.metrics.add(errors=1)
+        msg = "Not authorized to get %s after %d attempts" % (_url, retries)
+        echo(msg, FAIL, err=True)
+        raise requests.HTTPError(msg, response=res)
 
+    def worker_get(self, url, offset, limit, params=None, stats=None, raw=False, fields=None):
+        """
+        performs the get - params are added to the query string after
+        offset/limit, stats (e.g. the queue_wait of the worker) are recorded
+        with the request's own.  With raw the body is returned as a RawPage
+        instead of being decoded, else the records are cut down to a
+        Projection's fields as soon as they are decoded
+        """
+        _url = "{}?offset={}&limit={}".format(url, offset, limit)
+        if params:
+            _url += "&" + urlencode(params)
+        stats = dict(stats or {})
+        res = self.worker_request(_url, stats=stats, cache=True)
+        if raw:
+            self.record("GET " + _url, stats)
+            return RawPage(res.content)
+        start = time.time()
+        data = res.json()
+        if fields and isinstance(data, list):
+            data = fields.project(data)
+        stats['decode'] = time.time() - start
+        stats['records'] = len(data) if isinstance(data, list) else 1
+        self.record("GET %s (records: %d)" % (_url, stats['records']), stats)
         return data
 
-    def queue_worker(self):
-        """ worker of queues """
+    def queue_worker(self, q, pages, stop):
+        """
+        worker of queues - fetched pages are handed to the consumer through pages,
+        as is the error if a page could not be fetched
+        """
         while True:
-            payload = self.q.get()
+            start = time.time()
+            payload = q.get()
+            queue_wait = time.time() - start
             if not payload:
                 break
             invalid = False
@@ -224,79 +793,512 @@ class EdFi(object):
                     invalid = True
             if invalid:
                 break
+            if stop.is_set():
+                q.task_done()
+                continue
 
+            reorder = payload.get('reorder')
+            if reorder:
+                # too far ahead of the pages already handed out - wait for the others
+                reorder.wait(payload['offset'], stop)
+                if stop.is_set():
+                    q.task_done()
+                    continue
+            skip = payload.get('skip')
+            if skip and skip(payload['offset']):
+                # already have this page (resumed run) - move on to the next
+                payload['offset'] = payload['offset'] + (payload['workers'] * payload['limit'])
+                q.put(payload)
+                q.task_done()
+                continue
             try:
-                res = self.worker_get(payload['url'], payload['offset'], payload['limit'])
-                if not res:
-                    raise Exception("No more data")
-                self.__data.extend(res)  # this is thread safe
-                # submit a new task
-                payload['offset'] = payload['offset'] + (payload['workers'] * payload['limit']) # update with new page
-                time.sleep(0.5)
-                self.q.put(payload)
+                res = self.worker_get(payload['url'], payload['offset'], payload['limit'], payload.get('params'), {"queue_wait": queue_wait},
+                                      payload.get('raw', False), payload.get('fields'))
             except Exception as exp:
-                # no data, must be end
-                pass
-            self.q.task_done()
-
+                pages.put(exp)
+                res = None
+            if res:
+                start = time.time()
+                pages.put((payload['offset'], res)) # blocks while the consumer catches up
+                self.metrics.add(backpressure=time.time() - start)
+                # submit a new task - the pace is set by the throttle in worker_request
+                payload['offset'] = payload['offset'] + (payload['workers'] * payload['limit']) # update with new page
+                q.put(payload)
+            # else no data, must be end
+            q.task_done()
 
-    def get_parallel(self, url,limit):
-        """ gets via parallel operations """
+    def reorder_window(self, workers):
+        """ number of pages the reorder buffer may hold - defaults to twice the workers, never fewer than the workers """
+        try:
+            # a smaller window would leave workers waiting on pages past the end that nobody fetches
+            return max(workers, int(self.general_setting('reorder_window', 2 * workers)))
+        except:
+            return 2 * workers
 
+    def iter_parallel(self, url, limit, params=None, skip=None, raw=False, fields=None):
+        """
+        yields (offset, records) for each page fetched by max_workers threads, in offset
+        order - skip, raw and fields as for iter_serial
+        """
+        self.ensure_auth_token() # before the workers, so a failure is raised here
         # for each page, get data
-        max_workers = None # if none, use 5x processors of host as count - https://docs.python.org/3/library/concurrent.futures.html
-        if 'general' in self.cfg and 'max_workers' in self.cfg['general']:
-            try:
-                max_workers = max(1,int(self.cfg['general']['max_workers']))
-            except:
-                pass
+        max_workers = self.max_workers
 
-        self.q = Queue()
+        q = Queue()
+        pages = Queue(maxsize=max_workers)
+        stop = Event()
+        # puts the pages back in order - workers wait rather than run more than reorder_window pages ahead
+        reorder = ReorderBuffer(limit, self.reorder_window(max_workers), skip)
         threads = []
-        self.__data = []
         for i in range(max_workers):
-            t = Thread(target=self.queue_worker)
+            t = Thread(target=self.queue_worker, args=(q, pages, stop))
             t.start()
             threads.append(t)
 
         for i in range(max_workers): #start with max_wokers number of workers
-            self.q.put(dict(url=url, limit=limit, workers=max_workers, offset=i*limit))
+            q.put(dict(url=url, limit=limit, workers=max_workers, offset=i*limit, params=params, skip=skip, reorder=reorder, raw=raw, fields=fields))
+
+        def finish():
+            q.join()
+            for i in range(max_workers):
+                q.put(None)
+            for t in threads:
+                t.join()
+            pages.put(None)
+        Thread(target=finish).start()
+
+        done = False
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    done = True
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                for ready in reorder.add(*page):
+                    yield ready
+            for ready in reorder.rest():
+                yield ready
+        finally:
+            # consumer stopped early - let the workers drain
+            stop.set()
+            reorder.close()
+            while not done:
+                done = pages.get() is None
+
+    def iter_asyncio(self, url, limit, params=None, skip=None, raw=False, fields=None):
+        """
+        yields (offset, records) for each page fetched on an event loop in its own thread,
+        in offset order - skip, raw and fields as for iter_serial
+        """
+        if not aiohttp:
+            raise Exception("async_engine 'asyncio' requires aiohttp - pip3 install aiohttp")
+        self.ensure_auth_token()
+        concurrency = 100
+        try:
+            concurrency = max(1, int(self.general_setting('async_concurrency', concurrency)))
+        except:
+            pass
+        # a page holds its slot until the consumer takes it, pages more than
+        # reorder_window ahead of the next one out are not started
+        pages = Queue(maxsize=concurrency)
+        stop = Event()
+        reorder = ReorderBuffer(limit, self.reorder_window(concurrency), skip)
+
+        def run():
+            try:
+                asyncio.run(self._get_asyncio(url, limit, concurrency, pages, stop, params, skip, reorder, raw, fields))
+            except Exception as exp:
+                pages.put(exp)
+            pages.put(None)
+        Thread(target=run).start()
 
-        self.q.join()
+        done = False
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    done = True
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                for ready in reorder.add(*page):
+                    yield ready
+            for ready in reorder.rest():
+                yield ready
+        finally:
+            stop.set()
+            reorder.close()
+            while not done:
+                done = pages.get() is None
+
+    async def _get_asyncio(self, url, limit, concurrency, pages, stop, params=None, skip=None, reorder=None, raw=False, fields=None):
+        """
+        schedules pages in offset order, at most concurrency in flight (or
+        waiting on the consumer) at once - an empty or short page marks the
+        end of the data (only an empty one for raw pages, they are not counted)
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        # full is the highest offset known to have a full page - pages are only
+        # scheduled a few ahead of it, twice as many as full pages seen so far
+        state = {"end": None, "full": -limit, "pages": 0}
+        tasks = set()
 
-        for i in range(max_workers):
-            self.q.put(None)
-        for t in threads:
-            t.join()
+        def past_end(offset):
+            return state['end'] is not None and offset >= state['end']
 
-        return self.__data
+        async def fetch(session, offset):
+            try:
+                if past_end(offset):
+                    return # the end was found while this page waited for a slot
+                data = await self.async_worker_get(session, url, offset, limit, params, raw, fields,
+                                                   wanted=lambda: not past_end(offset))
+                if data is None:
+                    return
+                if not data or (not raw and len(data) < limit):
+                    end = offset + (len(data) if data and not raw else 0)
+                    state['end'] = end if state['end'] is None else min(state['end'], end)
+                else:
+                    state['full'] = max(state['full'], offset)
+                    state['pages'] += 1
+                start = time.time()
+                while data and not stop.is_set():
+                    try:
+                        pages.put_nowait((offset, data))
+                        break
+                    except Full:
+                        await asyncio.sleep(0.01)
+                self.metrics.add(backpressure=time.time() - start)
+            except Exception as exp:
+                # hand the error to the consumer now and stop scheduling, as queue_worker does
+                stop.set()
+                while True:
+                    try:
+                        pages.put_nowait(exp)
+                        break
+                    except Full:
+                        await asyncio.sleep(0.01)
+            finally:
+                semaphore.release()
+
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, ssl=None if self.verify_ssl else False)
+        # bodies are decompressed here (ContentDecoder) to count the bytes on the wire
+        async with aiohttp.ClientSession(connector=connector, auto_decompress=False, headers={"Accept-Encoding": self.accept_encoding}) as session:
+            offset = 0
+            while not stop.is_set():
+                if past_end(offset):
+                    break
+                if skip and skip(offset):
+                    offset += limit
+                    state['full'] = max(state['full'], offset - limit) # had before, full
+                    continue
+                ahead = min(concurrency, max(2, 2 * state['pages']))
+                if (reorder and reorder.ahead(offset)) or offset > state['full'] + ahead * limit:
+                    await asyncio.sleep(0.005)
+                    continue
+                await semaphore.acquire()
+                if stop.is_set() or past_end(offset):
+                    semaphore.release()
+                    break
+                task = asyncio.ensure_future(fetch(session, offset))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                offset += limit
+            await asyncio.gather(*tasks)
 
-    def get_serial(self, url, page=0, limit=100):
-        """ gets data serially """
-        data= []
+    async def async_worker_get(self, session, url, offset, limit, params=None, raw=False, fields=None, wanted=None):
+        """
+        performs the get on the event loop - same retries and throttling as worker_request.
+        Returns None without a request if wanted() turns false while waiting for a slot
+        """
+        _url = "{}?offset={}&limit={}".format(url, offset, limit)
+        if params:
+            _url += "&" + urlencode(params)
+        stats = {"retries": 0, "refreshes": 0, "throttle_wait": 0.0}
+        start = time.time()
+        entry = self.cache_load(_url)
+        content = None
+        if entry:
+            content = entry[2]
+            stats.update(duration=time.time() - start, ttfb=0.0, bytes=len(content), cache_hits=1)
+        retries = 0
+        while content is None:
+            if retries >= self.max_retries:
+                self.metrics.add(errors=1)
+                raise Exception("Could not get data from %s - retries exhausted" % _url)
+            retries += 1
+            if self.token_expiring():
+                # the refresh blocks (requests, file lock) - off the loop, so the other pages keep going
+                await asyncio.get_running_loop().run_in_executor(None, self.ensure_auth_token)
+            headers = dict(self.headers)
+            start = time.time()
+            if self.rate_limiter:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            while not self.throttle.acquire(blocking=False):
+                await asyncio.sleep(0.005)
+            stats['throttle_wait'] += time.time() - start
+            if wanted and not wanted():
+                self.throttle.release()
+                return None
+            start = time.time()
+            ok, failed = False, None
+            try:
+                async with session.get(_url, headers=headers) as res:
+                    ttfb = time.time() - start
+                    decoder = ContentDecoder(res.headers.get('Content-Encoding'))
+                    async for chunk in res.content.iter_any():
+                        decoder.feed(chunk)
+                    body = decoder.content()
+                ok = res.status not in RETRY_STATUSES
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as exp:
+                failed = exp # zlib.error is a garbled body - retried like a cut connection
+            except Exception as exp: # e.g. an unsupported Content-Encoding
+                self.metrics.add(errors=1)
+                raise Exception("Could not get data from %s - %s" % (_url, exp))
+            finally:
+                # whatever the request raised, the slot goes back before any backoff
+                duration = time.time() - start
+                self.throttle.release(duration, ok=ok)
+            if failed is not None:
+                if retries < self.max_retries:
+                    stats['retries'] += 1
+                    await asyncio.sleep(self.retry_delay(retries))
+                    continue
+                self.metrics.add(errors=1)
+                raise Exception("Could not get data from %s - %s" % (_url, failed))
+            if res.status == 401:
+                stats['refreshes'] += 1
+                await asyncio.get_running_loop().run_in_executor(None, self.refresh_auth_token, headers.get("Authorization"))
+                continue
+            if res.status in RETRY_STATUSES and retries < self.max_retries:
+                stats['retries'] += 1
+                await asyncio.sleep(self.retry_delay(retries, res.headers.get('Retry-After')))
+                continue
+            if res.status > 299:
+                self.metrics.add(errors=1)
+                echo("error on url: {}".format(url), FAIL, err=True)
+                raise Exception("HTTP error - {} on get to {} - {}".format(res.status, _url, body))
+            content = body
+            stats.update(duration=duration, ttfb=ttfb, bytes=len(content), wire_bytes=decoder.wire_bytes)
+            self.cache_save(_url, res.status, res.headers, content)
+        if raw:
+            self.record("GET " + _url, stats)
+            return RawPage(content)
+        start = time.time()
+        data = json.loads(content)
+        if fields and isinstance(data, list):
+            data = fields.project(data)
+        stats.update(decode=time.time() - start, records=len(data) if isinstance(data, list) else 1)
+        self.record("GET %s (records: %d)" % (_url, stats['records']), stats)
+        return data
+
+    def iter_serial(self, url, page=0, limit=100, params=None, skip=None, raw=False, fields=None):
+        """
+        yields (offset, records) for each page, serially - offsets for which
+        skip(offset) is true are not fetched, with raw the records are RawPages
+        and with fields they are projected
+        """
+        self.ensure_auth_token()
         if page == -1: # get all
             qs = {"limit": limit, "offset":0}
         else:
             qs = {"limit": limit, "offset": page*limit}
         while True:
-            _data = self.worker_get(url, qs['offset'], qs['limit'])
+            if skip and skip(qs['offset']):
+                qs['offset'] = qs['offset'] + qs['limit']
+                continue
+            _data = self.worker_get(url, qs['offset'], qs['limit'], params, raw=raw, fields=fields)
             if not _data:
                 break
-            if isinstance(_data, list):
-                data.extend(_data)
+            if isinstance(_data, (list, RawPage)):
+                yield qs['offset'], _data
             else:
-                data.append(_data)
+                yield qs['offset'], [_data]
             qs['offset'] = qs['offset'] + qs['limit']
             if page > -1:
                 break  # we are getting a specific page, so just break and move on
-        return data
 
-    def get(self, endpoint, page=0, limit=100):
-        """ get 'factory' """
-        url = self.__build_url(endpoint)
+    def iter_extract(self, endpoints, limit=100):
+        """
+        yields (endpoint, offset, records) for every page of several endpoints from one pool
+        of max_workers threads, in offset order, and (endpoint, None, error) once one is finished
+        """
+        max_workers = self.max_workers
+        lanes = max_workers
+        try:
+            lanes = max(1, int(self.general_setting('extract_lanes', lanes)))
+        except:
+            pass
+        if not endpoints:
+            return
+        self.ensure_auth_token()
+
+        window = self.reorder_window(lanes)
+        state = {endpoint: {"url": self.__build_url(endpoint), "next": 0, "lanes": 1, "inflight": 0, "done": False, "finished": False, "error": None,
+                            "reorder": ReorderBuffer(limit, window)} for endpoint in endpoints}
+        remaining = [len(state)]
+        # tokens of the endpoints - a worker takes the next offset of the one at the front and
+        # puts it at the back, so small endpoints finish early while large ones keep paging
+        ready = Queue()
+        pages = Queue(maxsize=max_workers)
+        lock = Lock()
+        stop = Event()
+
+        def finish(endpoint):
+            """ called under the lock - true the first time an endpoint is done with nothing in flight """
+            st = state[endpoint]
+            if not st['done'] or st['inflight'] or st['finished']:
+                return False
+            st['finished'] = True
+            remaining[0] -= 1
+            return True
+
+        def finished(endpoint):
+            pages.put((endpoint, None, state[endpoint]['error']))
+            with lock:
+                last = remaining[0] == 0
+            if last:
+                for i in range(max_workers):
+                    ready.put(None)
+                pages.put(None)
+
+        def worker():
+            while True:
+                start = time.time()
+                endpoint = ready.get()
+                queue_wait = time.time() - start
+                if endpoint is None:
+                    break
+                st = state[endpoint]
+                deferred = False
+                with lock:
+                    if stop.is_set():
+                        st['done'] = True
+                    if st['done']:
+                        # the endpoint ended while this token waited - drop it
+                        done = finish(endpoint)
+                        offset = None
+                    elif st['reorder'].ahead(st['next']):
+                        # more than reorder_window pages ahead - passed over until it catches up
+                        done = False
+                        offset = None
+                        deferred = True
+                    else:
+                        offset = st['next']
+                        st['next'] += limit
+                        st['inflight'] += 1
+                if offset is None:
+                    if done:
+                        finished(endpoint)
+                    if deferred:
+                        # give the pages in flight a moment before trying again
+                        time.sleep(0.01)
+                        ready.put(endpoint)
+                    continue
+
+                data, error = [], None
+                try:
+                    data = self.worker_get(st['url'], offset, limit, stats={"queue_wait": queue_wait})
+                except Exception as exp:
+                    error = exp
+                if data:
+                    start = time.time()
+                    pages.put((endpoint, offset, data))
+                    self.metrics.add(backpressure=time.time() - start)
+                with lock:
+                    st['inflight'] -= 1
+                    if error:
+                        st['error'] = error
+                    more = False
+                    if error or not data or len(data) < limit:
+                        st['done'] = True
+                    else:
+                        # a full page adds a token, up to extract_lanes
+                        more = st['lanes'] < lanes
+                        if more:
+                            st['lanes'] += 1
+                    done = finish(endpoint)
+                if done:
+                    finished(endpoint)
+                elif not st['done']:
+                    ready.put(endpoint)
+                    if more:
+                        ready.put(endpoint)
+
+        threads = []
+        for i in range(max_workers):
+            t = Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for endpoint in state:
+            ready.put(endpoint)
+
+        done = False
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    done = True
+                    break
+                endpoint, offset, records = page
+                reorder = state[endpoint]['reorder']
+                if offset is None:
+                    for ready_page in reorder.rest():
+                        yield (endpoint, ) + ready_page
+                    yield page
+                    continue
+                for ready_page in reorder.add(offset, records):
+                    yield (endpoint, ) + ready_page
+        finally:
+            stop.set()
+            while not done:
+                done = pages.get() is None
+            for t in threads:
+                t.join()
+
+    def iter_url(self, url, page=0, limit=100, params=None, skip=None, raw=False, fields=None):
+        """
+        (offset, records) page generator 'factory' - pages are yielded as they
+        arrive.  With raw the records are RawPages - the bodies as received,
+        fields is a Projection applied to the records as they are decoded
+        """
         if page<1 and 'general' in self.cfg and 'async_requests' in self.cfg['general'] and self.cfg['general']['async_requests']:
-            return self.get_parallel(url, limit)
-        return self.get_serial(url, page, limit)
+            if self.general_setting('async_engine') == "asyncio":
+                return self.iter_asyncio(url, limit, params, skip, raw, fields)
+            return self.iter_parallel(url, limit, params, skip, raw, fields)
+        return self.iter_serial(url, page, limit, params, skip, raw, fields)
+
+    def iter_pages(self, endpoint, page=0, limit=100, skip=None, raw=False, params=None, fields=None):
+        """ (offset, records) pages of an endpoint - params are query parameters (filters) """
+        return self.iter_url(self.__build_url(endpoint), page, limit, params, skip, raw, fields)
+
+    def get_change_versions(self):
+        """ returns the (oldest, newest) change versions available from a 3.x api """
+        if not self.api_ver.startswith("v3."):
+            raise Exception("Change queries require a 3.x api - %s is %s" % (self.customer_id, self.api_ver))
+        res = self.worker_request("{}/api/changeQueries/v1/availableChangeVersions".format(self.baseurl))
+        versions = {k.lower(): v for k, v in res.json().items()}
+        if 'newestchangeversion' not in versions:
+            raise Exception("Invalid change version data - %s" % res.content)
+        return versions.get('oldestchangeversion'), versions['newestchangeversion']
+
+    def iter_changes(self, endpoint, min_version, max_version, limit=100, deletes=False):
+        """
+        (offset, records) pages of the records changed (or deleted) in the
+        change version window - min_version of None starts from the beginning
+        """
+        url = self.__build_url(endpoint)
+        if deletes:
+            url += "/deletes"
+        params = {"maxChangeVersion": max_version}
+        if min_version is not None:
+            params["minChangeVersion"] = min_version
+        return self.iter_url(url, -1, limit, params)
+
+    def get(self, endpoint, page=0, limit=100):
+        """ the records of a page (all with page=-1) of an endpoint, as a list """
+        return [record for offset, records in self.iter_pages(endpoint, page, limit) for record in records]
 
     def build_properties_2x(self, models, prop_name, prop):
         """ builds the properties """
@@ -331,54 +1333,42 @@ class EdFi(object):
 
     def _structure_3x(self, endpoint):
         """ fetches the structure of endpoints for 3.x"""
-        data = {}
-        data.update(self._get_endpoint_data_3x())
-
-        _endpoint = "edFi_" + endpoint
+        return self.schema_index().structure(endpoint)
 
-        if _endpoint not in data['definitions']:
-            raise Exception("No endpoint '%s' was found in endpoint data" % endpoint)
-        if 'properties' not in data['definitions'][_endpoint]:
-            raise Exception("No properties were found for endpoint '%s'" % endpoint)
-        properties = {}
-        for prop_name, prop in data['definitions'][_endpoint]['properties'].items():
-            if 'type' not in prop:
-                continue
-            properties.update(self.build_properties_3x(data['definitions'], prop_name, prop))
-
-        return properties
-
-    def build_properties_3x(self, definitions, prop_name, prop):
-        """ builds properties for ver 3x """
-        props = {}
-
-        if prop['type'] in ["integer", "string", "boolean", "date-time", "number"]:
-            # simple type
-            props[prop_name] = prop['type'].replace("-", "")
-        elif prop['type'] == "array":
-            props[prop_name] = {}
-            for subprop_name, subprop in definitions[os.path.basename(prop['items']['$ref'])]['properties'].items():
-                props[prop_name].update(self.build_properties_3x(definitions, subprop_name, subprop))
+    def schema_index(self):
+        """
+        the SchemaIndex of the 3.x swagger - loaded from the metadata cache when it
+        was built from the swagger document currently cached, else built and saved.
+        Kept in memory for metadata_ttl, then checked against the swagger again
+        """
+        if self._schema_index and time.time() - self._schema_index[2] < self.metadata_ttl():
+            return self._schema_index[0]
+        url = "{}/api/metadata/data/v3/resources/swagger.json".format(self.baseurl)
+        source = self.get_metadata_entry(url)
+        if self._schema_index and source.get('downloaded') == self._schema_index[1]:
+            index = self._schema_index[0] # swagger unchanged
         else:
-            if prop['type'] not in definitions:
-                raise Exception("Could not find definition %s to build property %s" % (prop['type'], prop_name))
-            for ref_key, ref_prop in definitions[prop['type']]['properties'].items():
-                base_key = "{}_{}".format(prop_name, ref_key)
-                if ref_prop['type'] in ['link']:
-                    props["{}_href".format(base_key)] = "string"
-                    props["{}_rel".format(base_key)] = "string"
-                else:
-                    props[base_key] = ref_prop['type']
-        return props
-
-
+            cached = self.metadata_cache.load(url + "#schema-index") if self.metadata_cache else None
+            if cached and source.get('downloaded') and cached['source'] == source['downloaded']:
+                index = SchemaIndex.from_dict(cached['data'])
+            else:
+                self._get_endpoint_data_3x() # validates the document
+                index = SchemaIndex.from_swagger(source['data'])
+                if self.metadata_cache:
+                    self.metadata_cache.save(url + "#schema-index", {"source": source['downloaded'], "data": index.to_dict()})
+        self._schema_index = (index, source.get('downloaded'), time.time())
+        return index
+
+    def structures(self):
+        """ returns the structure of every endpoint """
+        if self.api_ver.startswith("v3."):
+            return self.schema_index().structures()
+        return {endpoint: self.structure(endpoint) for endpoint in self.get_endpoints()}
 
     def _structure_2x(self, endpoint):
         """ fetches the structure of endpoints for 2.x"""
         url = "{}/metadata/resources/api-docs/{}".format(self.baseurl, endpoint)
-        data = self.get_serial(url)
-        if data:
-            data = data[0]
+        data = self.get_metadata(url)
         if 'apis' not in data:
             raise Exception("No 'apis' found in structure data for %s" % endpoint)
         model = None
@@ -413,17 +1403,110 @@ class EdFi(object):
         
     def get_record(self, endpoint, record_id):
         """
-        Gets a particular record from an endpoint
+        Gets a particular record from an endpoint - None if there is no record
+        with that id
+        """
+        status, record = self.fetch_record(self.__build_url(endpoint), record_id)
+        return record
+
+    def fetch_record(self, url, record_id):
+        """
+        (status, record) for a record id of the endpoint at url - a single get
+        of the record's url, the record is None for a 404
+        """
+        _url = "{}/{}".format(url, quote(str(record_id), safe=""))
+        stats = {}
+        res = self.worker_request(_url, stats=stats, accept=(404,), cache=True)
+        if res.status_code == 404:
+            self.record("GET " + _url, stats)
+            return res.status_code, None
+        start = time.time()
+        record = res.json()
+        stats.update(decode=time.time() - start, records=1)
+        self.record("GET " + _url, stats)
+        return res.status_code, record
+
+    def iter_records(self, endpoint, record_ids):
         """
-        url = "{}/{}".format(self.__build_url(endpoint), record_id)
-        return self.get_serial(url)
+        yields (record_id, status, record, error) for each of record_ids, in
+        the order given.  The ids are fetched by max_workers threads over the
+        pooled session and read no more than reorder_window ahead of the one
+        yielded, so they can be streamed from a file of any size.  An id that
+        fails (after the retries) is yielded with the error, the rest carry on
+        """
+        url = self.__build_url(endpoint)
+        self.ensure_auth_token()
+        window = self.reorder_window(self.max_workers)
+
+        def fetch(record_id):
+            try:
+                status, record = self.fetch_record(url, record_id)
+                return record_id, status, record, None
+            except Exception as exp:
+                return record_id, None, None, str(exp)
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for record_id in record_ids:
+                pending.append(pool.submit(fetch, record_id))
+                while len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def get_metadata(self, url):
+        """ gets a metadata document (swagger/api-docs) through the metadata cache """
+        return self.get_metadata_entry(url)['data']
+
+    def metadata_ttl(self):
+        """ seconds metadata is used before it is revalidated """
+        ttl = 24 * 60 * 60
+        try:
+            ttl = float(self.general_setting('metadata_ttl', ttl))
+        except:
+            pass
+        return ttl
+
+    def get_metadata_entry(self, url):
+        """
+        gets the metadata cache entry for a url - within metadata_ttl the cached
+        copy is used as is, after that it is revalidated with
+        If-None-Match/If-Modified-Since.  'downloaded' is when the document
+        itself was last downloaded
+        """
+        entry = self.metadata_cache.load(url) if self.metadata_cache else None
+        if entry:
+            entry.setdefault('downloaded', entry['fetched']) # entries cached before 'downloaded' was kept
+        if entry and time.time() - entry['fetched'] < self.metadata_ttl():
+            return entry
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        res = self.worker_request(url, headers)
+        if res.status_code == 304:
+            entry['fetched'] = time.time()
+        else:
+            data = res.json()
+            if isinstance(data, list) and data:
+                data = data[0]
+            entry = {
+                "fetched": time.time(),
+                "downloaded": time.time(),
+                "etag": res.headers.get('ETag'),
+                "last_modified": res.headers.get('Last-Modified'),
+                "data": data
+            }
+        if self.metadata_cache:
+            self.metadata_cache.save(url, entry)
+        return entry
 
     def get_endpoints_2x(self):
         """ gets endpoints for api ver 2x """
         url = "{}/metadata/resources/api-docs".format(self.baseurl)
-        res = self.get_serial(url)
-        if res:
-            res = res[0]
+        res = self.get_metadata(url)
         if res and "apis" in res:
             return [x["path"][1:] for x in res['apis']]
         return []
@@ -431,9 +1514,7 @@ class EdFi(object):
     def _get_endpoint_data_3x(self):
         """ gets endpoints for api ver 3x """
         url = "{}/api/metadata/data/v3/resources/swagger.json".format(self.baseurl)
-        data = self.get_serial(url)
-        if data:
-            data = data[0]
+        data = self.get_metadata(url)
         if not data:
             raise Exception("No data found for endpoints")
         if 'paths' not in data:
@@ -452,47 +1533,1528 @@ class EdFi(object):
             return self.get_endpoints_3x()
         return []
 
-    def get_count(self, endpoint=None, url=None):
-        """ use binary search to find end of records """
-        # first find upper bounds
+    def get_count(self, endpoint=None, url=None, concurrent=True):
+        """ counts the records of an endpoint - probes run serially unless concurrent """
         if endpoint:
             url = self.__build_url(endpoint)
-        n = 100
-        while True:
-            if self.get_serial(url, page=n, limit=1):
-                n = n * 10
-                continue
-            break
+        if self.api_ver.startswith("v3."):
+            count = self._count_3x(url)
+            if count is not None:
+                return count
+        return self._count_probe(url, concurrent)
 
-        # now binary search in scope
-        q = int(n/2)
-        d = int(max(1, q/2))
+    def check_endpoint(self, endpoint, counts=False):
+        """
+        (data, count) for an endpoint - data is true if it has at least one
+        record, count is the number of records when counts is true (else None).
+        Presence is a single limit=1 get, for 3.x the same get asks for the
+        Total-Count so both come from one request.  Counts are probed serially,
+        the endpoints being checked concurrently
+        """
+        url = self.__build_url(endpoint)
+        _url = "{}?offset=0&limit=1".format(url)
+        if counts and self.api_ver.startswith("v3."):
+            _url += "&totalCount=true"
+        stats = {}
+        res = self.worker_request(_url, stats=stats)
+        start = time.time()
+        records = res.json()
+        stats.update(decode=time.time() - start, records=len(records) if isinstance(records, list) else 1)
+        self.record("GET %s (records: %d)" % (_url, stats['records']), stats)
+        data = bool(records)
+        count = None
+        if counts:
+            if not data:
+                count = 0
+            elif 'Total-Count' in res.headers:
+                count = int(res.headers['Total-Count'])
+            else:
+                count = self._count_probe(url, concurrent=False)
+        return data, count
 
-        while True:
-            if q > n:
-                raise Exception("Cannot search past top bound")
-            d = int(max(1, d/2))
-            recs = self.get_serial(url, page=q, limit=2)
-            if recs:
-                # found records, if there is only one, then we have reached the end
-                if len(recs) == 1:
-                    # we have reached the end
-                    n = q
+    def _count_3x(self, url):
+        """ 3.x returns the count in the Total-Count header when asked for - None if it did not """
+        res = self.worker_request("{}?offset=0&limit=1&totalCount=true".format(url), cache=True)
+        if 'Total-Count' not in res.headers:
+            return None
+        return int(res.headers['Total-Count'])
+
+    def _count_probe(self, url, concurrent=True):
+        """
+        finds the number of records by probing offsets with limit=1.  Each round
+        probes up to COUNT_PROBES offsets concurrently (one at a time unless
+        concurrent) - first growing tenfold until an offset without a record is
+        found, then narrowing the range between the last offset with a record
+        (lo) and the first without one (hi)
+        """
+        probes = max(2, min(self.max_workers, COUNT_PROBES)) if concurrent else 1
+
+        def exists(offset):
+            return bool(self.worker_get(url, offset, 1))
+
+        lo, hi = -1, None
+        offsets = [0] + [100 * 10 ** i for i in range(max(1, probes - 1))]
+        with ThreadPoolExecutor(max_workers=probes) as pool:
+            run = pool.map if concurrent else map
+            while True:
+                for offset, present in zip(offsets, run(exists, offsets)):
+                    if present:
+                        lo = max(lo, offset)
+                    elif hi is None or offset < hi:
+                        hi = offset
+                if hi is not None and hi <= lo:
+                    raise Exception("Inconsistent record counts while probing %s" % url)
+                if hi is None:
+                    offsets = [o for o in (max(lo, 100) * 10 ** (i + 1) for i in range(probes)) if o <= COUNT_PROBE_MAX]
+                    if not offsets:
+                        raise Exception("More than %d records while probing %s" % (COUNT_PROBE_MAX, url))
+                elif hi - lo <= 1:
                     break
-                q += d
+                elif hi - lo - 1 <= probes:
+                    offsets = list(range(lo + 1, hi))
+                else:
+                    step = (hi - lo) / (probes + 1)
+                    offsets = sorted(set(int(lo + step * (i + 1)) for i in range(probes)))
+        return lo + 1
+
+class RecordWriter(object):
+    """
+    Streams records to a file as they arrive, either as a json array (same
+    layout as json.dump) or as ndjson - one record per line.  Without an
+    indent (None or 0) the json is compact, no spaces between tokens
+    """
+    def __init__(self, output, fmt="json", indent=4):
+        self.output = output
+        self.fmt = fmt
+        self.indent = indent or None
+        self.separators = (",", ":") if self.indent is None else None
+        self.count = 0
+
+    def write(self, records):
+        """ writes a page of records """
+        chunks = []
+        for record in records:
+            if self.fmt == "ndjson":
+                chunks.append(json.dumps(record, separators=self.separators) + "\n")
+                continue
+            if self.indent is None:
+                chunks.append(("[" if not self.count + len(chunks) else ",") + json.dumps(record, separators=self.separators))
             else:
-                # need to search "down"s
-                q -= d
-            if q < 0:
+                prefix = "[\n" if not self.count + len(chunks) else ",\n"
+                text = json.dumps(record, indent=self.indent).replace("\n", "\n" + " " * self.indent)
+                chunks.append(prefix + " " * self.indent + text)
+        if chunks:
+            self.output.write("".join(chunks))
+            self.count += len(chunks)
+
+    def close(self):
+        """ closes out the array - nothing is written if there were no records """
+        if not self.count:
+            return
+        if self.fmt == "json":
+            self.output.write("]" if self.indent is None else "\n]")
+        self.output.flush()
+
+JSON_WHITESPACE = b" \t\r\n"
+
+class RawPage(object):
+    """
+    A page's body as received - the json array is not decoded, only its
+    brackets are found to tell an empty page from one with records
+    """
+    __slots__ = ("body", "start", "end")
+
+    def __init__(self, body):
+        self.body = body
+        start, end = 0, len(body)
+        while start < end and body[start] in JSON_WHITESPACE:
+            start += 1
+        while end > start and body[end - 1] in JSON_WHITESPACE:
+            end -= 1
+        if body[start:start + 1] != b"[" or body[end - 1:end] != b"]":
+            raise Exception("Page is not a json array - %s" % body[:100])
+        start, end = start + 1, end - 1
+        while start < end and body[start] in JSON_WHITESPACE:
+            start += 1
+        while end > start and body[end - 1] in JSON_WHITESPACE:
+            end -= 1
+        self.start = start
+        self.end = end
+
+    def __bool__(self):
+        return self.start < self.end
+
+    def records(self):
+        """ the records between the brackets, still encoded """
+        return memoryview(self.body)[self.start:self.end]
+
+class RawWriter(object):
+    """
+    Writes RawPages to a file without decoding them - "raw" splices the pages
+    into one json array, "raw-pages" writes each page's array on a line of its
+    own.  count is the number of pages written
+    """
+    def __init__(self, output, fmt="raw"):
+        self.output = output
+        self.fmt = fmt
+        self.count = 0
+        self.stream = None
+
+    def write(self, page):
+        """ writes a page """
+        if not page:
+            return
+        if self.stream is None:
+            # bytes go under the text layer of the file
+            self.stream = getattr(self.output, "buffer", self.output)
+        if self.fmt == "raw-pages":
+            records = page.records()
+            if b"\n" in records or b"\r" in records:
+                # line breaks in json can only be whitespace between tokens
+                records = bytes(records).replace(b"\r", b"").replace(b"\n", b"")
+            self.stream.write(b"[")
+            self.stream.write(records)
+            self.stream.write(b"]\n")
+        else:
+            self.stream.write(b"," if self.count else b"[")
+            self.stream.write(page.records())
+        self.count += 1
+
+    def close(self):
+        """ closes out the array - nothing is written if there were no pages """
+        if not self.count:
+            return
+        if self.fmt == "raw":
+            self.stream.write(b"]")
+        self.stream.flush()
+
+class ContentDecoder(object):
+    """
+    Streaming decoder of a response body - gzip, deflate or identity as the
+    Content-Encoding says.  Chunks are decompressed as they come off the wire
+    and counted (wire_bytes)
+    """
+    def __init__(self, encoding):
+        encoding = (encoding or "identity").strip().lower()
+        if encoding not in ("gzip", "x-gzip", "deflate", "identity"):
+            raise Exception("Unsupported Content-Encoding %s" % encoding)
+        self.raw_deflate = encoding == "deflate" # deflate may come without its zlib header
+        self.zlib = None
+        if encoding != "identity":
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS if "gzip" in encoding else zlib.MAX_WBITS)
+        self.wire_bytes = 0
+        self.chunks = []
+
+    def feed(self, chunk):
+        """ decodes the next chunk of the body """
+        self.wire_bytes += len(chunk)
+        if self.zlib is None:
+            self.chunks.append(chunk)
+            return
+        try:
+            self.chunks.append(self.zlib.decompress(chunk))
+        except zlib.error:
+            if not self.raw_deflate or self.wire_bytes != len(chunk):
+                raise
+            self.raw_deflate = False
+            self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.chunks.append(self.zlib.decompress(chunk))
+
+    def content(self):
+        """ the decoded body """
+        if self.zlib is not None:
+            self.chunks.append(self.zlib.flush())
+        return b"".join(self.chunks)
+
+class SchemaIndex(object):
+    """
+    Flattened structure of every definition in a 3.x swagger document.  Each
+    definition is resolved once and kept, so shared types (references,
+    descriptors) are not walked again for every resource that uses them.  A
+    definition that refers back to itself while being resolved is kept as an
+    "object" column instead of recursing.  The index is plain data and is
+    saved next to the swagger in the metadata cache
+    """
+    SIMPLE_TYPES = ["integer", "string", "boolean", "date-time", "number"]
+
+    def __init__(self, definitions=None, resources=None, resolved=None):
+        self.definitions = definitions or {}
+        self.resources = resources or {}
+        self.resolved = resolved or {}
+        self.resolving = set()
+
+    @classmethod
+    def from_swagger(cls, data):
+        """ builds the index for all resources of a swagger document """
+        index = cls(data.get('definitions', {}))
+        for path, operations in data.get('paths', {}).items():
+            parts = path.split("/")
+            if len(parts) != 3:
+                continue
+            try:
+                ref = operations['get']['responses']['200']['schema']['items']['$ref']
+            except (KeyError, TypeError):
+                ref = None
+            index.resources[parts[2]] = os.path.basename(ref) if ref else index.definition_name(parts[2])
+        for endpoint, name in index.resources.items():
+            if name:
+                index.resolve(name)
+        return index
+
+    def definition_name(self, endpoint):
+        """ guesses the definition of an endpoint from its name - edFi_<endpoint> singular or plural """
+        candidates = [endpoint]
+        if endpoint.endswith("ies"):
+            candidates.append(endpoint[:-3] + "y")
+        if endpoint.endswith("s"):
+            candidates.append(endpoint[:-1])
+        for candidate in candidates:
+            if "edFi_" + candidate in self.definitions:
+                return "edFi_" + candidate
+        return None
+
+    def to_dict(self):
+        """ the index without the swagger definitions - what is saved to disk """
+        return {"resources": self.resources, "resolved": self.resolved}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(resources=data['resources'], resolved=data['resolved'])
+
+    def resolve(self, name):
+        """ returns the flattened properties of a definition """
+        if name in self.resolved:
+            return self.resolved[name]
+        if name not in self.definitions:
+            raise Exception("Could not find definition %s" % name)
+        if 'properties' not in self.definitions[name]:
+            raise Exception("No properties were found for definition '%s'" % name)
+        self.resolving.add(name)
+        props = {}
+        try:
+            for prop_name, prop in self.definitions[name]['properties'].items():
+                props.update(self.build_properties(prop_name, prop))
+        finally:
+            self.resolving.discard(name)
+        self.resolved[name] = props
+        return props
+
+    def build_properties(self, prop_name, prop):
+        """ flattens a property - references become <prop>_<key> columns, arrays a nested structure """
+        ref = prop.get('$ref')
+        kind = prop.get('type')
+        if kind in self.SIMPLE_TYPES:
+            return {prop_name: kind.replace("-", "")}
+        if kind == "array":
+            items = prop.get('items', {})
+            if '$ref' not in items:
+                return {prop_name: "array"}
+            ref_name = os.path.basename(items['$ref'])
+            if ref_name in self.resolving:
+                return {prop_name: "object"}
+            return {prop_name: dict(self.resolve(ref_name))}
+        if not ref and kind in self.definitions:
+            ref = kind # 2.x style reference by type name
+        if not ref:
+            return {prop_name: kind or "object"}
+        ref_name = os.path.basename(ref)
+        if ref_name in self.resolving:
+            return {prop_name: "object"}
+        return {"{}_{}".format(prop_name, key): value for key, value in self.resolve(ref_name).items()}
+
+    def structure(self, endpoint):
+        """ returns the structure of an endpoint - by resource name (students) or definition (student) """
+        name = self.resources.get(endpoint) or self.definition_name(endpoint)
+        if not name and "edFi_" + endpoint in self.resolved:
+            name = "edFi_" + endpoint
+        if not name:
+            raise Exception("No endpoint '%s' was found in endpoint data" % endpoint)
+        return self.resolve(name)
+
+    def structures(self):
+        """ returns the structure of every endpoint """
+        return {endpoint: self.resolve(name) for endpoint, name in sorted(self.resources.items()) if name}
+
+class ReorderBuffer(object):
+    """
+    Puts pages fetched in parallel back in offset order.  Pages are added as
+    they arrive and come back out once every page before them is in.
+    Fetchers check ahead/wait before fetching an offset, so no more than
+    window pages past the next one out are ever fetched and held
+    """
+    def __init__(self, limit, window, skip=None):
+        self.limit = limit
+        self.window = window
+        self.skip = skip
+        self.next = 0
+        self.pages = {}
+        self.closed = False
+        self.cond = Condition()
+        self._skip_ahead()
+
+    def _skip_ahead(self):
+        while self.skip and self.skip(self.next):
+            self.next += self.limit
+
+    def ahead(self, offset):
+        """ true if offset is too far ahead to be fetched yet """
+        with self.cond:
+            return not self.closed and offset >= self.next + self.window * self.limit
+
+    def wait(self, offset, stop=None):
+        """ waits until offset may be fetched (or the buffer is closed or stop is set) """
+        with self.cond:
+            while not self.closed and offset >= self.next + self.window * self.limit:
+                if stop and stop.is_set():
+                    return
+                self.cond.wait(0.1)
+
+    def add(self, offset, records):
+        """ adds a page - returns the [(offset, records)] that are now in order """
+        with self.cond:
+            self.pages[offset] = records
+            ready = []
+            while self.next in self.pages:
+                ready.append((self.next, self.pages.pop(self.next)))
+                self.next += self.limit
+                self._skip_ahead()
+            if ready:
+                self.cond.notify_all()
+            return ready
+
+    def rest(self):
+        """ returns what is left once fetching is over, in offset order """
+        with self.cond:
+            ready = sorted(self.pages.items())
+            self.pages = {}
+            return ready
+
+    def close(self):
+        """ releases any waiting fetchers """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Flattener(object):
+    """
+    Flattens records to the columns of an endpoint's structure - the column
+    names are split into key paths once (schoolReference_link_href reads
+    record['schoolReference']['link']['href']) and applied to every record.
+    Arrays are kept as a json column
+    """
+    def __init__(self, structure):
+        self.columns = []
+        self.types = []
+        self.getters = []
+        for name, kind in structure.items():
+            self.columns.append(name)
+            self.types.append("array" if isinstance(kind, dict) else kind)
+            self.getters.append(self._compile(self.column_path(name), isinstance(kind, dict)))
+
+    @staticmethod
+    def column_path(name):
+        """ splits a column name into its keys - a leading underscore belongs to the key (_etag) """
+        path = []
+        underscore = False
+        for key in name.split("_"):
+            if not key:
+                underscore = True
+                continue
+            path.append("_" + key if underscore else key)
+            underscore = False
+        return path
+
+    @staticmethod
+    def _compile(path, as_json):
+        def getter(record):
+            value = record
+            for key in path:
+                if not isinstance(value, dict):
+                    return None
+                value = value.get(key)
+            if value is not None and (as_json or isinstance(value, (dict, list))):
+                return json.dumps(value)
+            return value
+        return getter
+
+    def rows(self, records):
+        """ returns the rows for a page of records """
+        getters = self.getters
+        return [[getter(record) for getter in getters] for record in records]
+
+class Projection(object):
+    """
+    Keeps only some fields of records - fields are named as the columns of
+    the endpoint's structure, an object (schoolReference) or array may be
+    kept whole or an object by its columns (schoolReference_schoolId).  The
+    records keep their nesting
+    """
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.paths = [Flattener.column_path(field) for field in self.fields]
+
+    @classmethod
+    def parse(cls, value, structure):
+        """ a Projection from a comma separated list of fields - checked against the structure """
+        fields = [field.strip() for field in value.split(",") if field.strip()]
+        for field in fields:
+            if field not in structure and not any(column.startswith(field + "_") for column in structure):
+                raise click.BadParameter("%s is not a field - one of %s" % (field, ", ".join(structure)), param_hint="--fields")
+        return cls(fields)
+
+    def structure(self, structure):
+        """ the part of a structure that is kept """
+        return {column: kind for column, kind in structure.items()
+                if any(column == field or column.startswith(field + "_") for field in self.fields)}
+
+    def project(self, records):
+        """ the records with only the fields """
+        paths = self.paths
+        projected = []
+        for record in records:
+            out = {}
+            for path in paths:
+                value = record
+                for key in path:
+                    if not isinstance(value, dict) or key not in value:
+                        break
+                    value = value[key]
+                else:
+                    target = out
+                    for key in path[:-1]:
+                        target = target.setdefault(key, {})
+                    target[path[-1]] = value
+            projected.append(out)
+        return projected
+
+class CsvWriter(object):
+    """ Streams records to a csv file, flattened to the endpoint's structure """
+    def __init__(self, output, flattener):
+        self.output = output
+        self.flattener = flattener
+        self.writer = None
+        self.count = 0
+
+    def write(self, records):
+        """ writes a page of records """
+        if not records:
+            return
+        if not self.writer:
+            self.writer = csv.writer(self.output, lineterminator="\n")
+            self.writer.writerow(self.flattener.columns)
+        self.writer.writerows(self.flattener.rows(records))
+        self.count += len(records)
+
+    def close(self):
+        """ flushes the file - nothing is written if there were no records """
+        if self.count:
+            self.output.flush()
+
+class ParquetWriter(object):
+    """
+    Streams records to a parquet file, flattened to the endpoint's structure -
+    rows are collected by column and written as a row group every
+    row_group_size records
+    """
+    ARROW_TYPES = {"integer": "int64", "number": "float64", "boolean": "bool_"}
+
+    def __init__(self, filename, flattener, row_group_size=100000):
+        if not pyarrow:
+            raise Exception("--format=parquet requires pyarrow - pip3 install pyarrow")
+        self.filename = filename
+        self.flattener = flattener
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([
+            (name, getattr(pyarrow, self.ARROW_TYPES.get(kind, "string"))())
+            for name, kind in zip(flattener.columns, flattener.types)])
+        self.writer = None
+        self.buffer = [[] for c in flattener.columns]
+        self.buffered = 0
+        self.count = 0
+
+    def write(self, records):
+        """ writes a page of records """
+        for row in self.flattener.rows(records):
+            for column, value in zip(self.buffer, row):
+                column.append(value)
+        self.buffered += len(records)
+        self.count += len(records)
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """ writes the buffered rows as a row group """
+        if not self.buffered:
+            return
+        if not self.writer:
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(self.buffer, self.schema)], schema=self.schema))
+        self.buffer = [[] for c in self.flattener.columns]
+        self.buffered = 0
+
+    def close(self):
+        """ writes the last row group and closes the file - nothing is written if there were no records """
+        self.flush()
+        if self.writer:
+            self.writer.close()
+
+def build_writer(edfi, endpoint, fmt, output, fields=None, indent=None):
+    """
+    returns the writer for the output format - csv and parquet are flattened
+    to the endpoint's structure (the part of it in the fields Projection),
+    json is indented by indent spaces (None for compact)
+    """
+    if fmt in ["json", "ndjson"]:
+        return RecordWriter(output, fmt, indent)
+    if fmt in RAW_FORMATS:
+        return RawWriter(output, fmt)
+    structure = edfi.structure(endpoint)
+    flattener = Flattener(fields.structure(structure) if fields else structure)
+    if fmt == "csv":
+        return CsvWriter(output, flattener)
+    row_group_size = 100000
+    try:
+        row_group_size = max(1, int(edfi.general_setting('parquet_row_group_size', row_group_size)))
+    except:
+        pass
+    return ParquetWriter(output.name, flattener, row_group_size)
+
+RECORD_FORMATS = ["json", "ndjson", "csv", "parquet"]
+RAW_FORMATS = ["raw", "raw-pages"] # written as received, without decoding the pages - get only
+OUTPUT_FORMATS = RECORD_FORMATS + RAW_FORMATS
+
+class JsonFormatter(logging.Formatter):
+    """ formats profile entries as a line of json - the fields given as extra are included """
+    FIELDS = ("duration", "ttfb", "decode", "bytes", "wire_bytes", "records", "retries", "refreshes", "cache_hits", "queue_wait", "throttle_wait")
+
+    def format(self, record):
+        entry = {"datetime": self.formatTime(record), "message": record.getMessage()}
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = round(value, 6) if isinstance(value, float) else value
+        return json.dumps(entry)
+
+class Metrics(object):
+    """
+    Aggregates of the requests made - counters, total seconds and a latency
+    histogram.  Recording is a few additions under a lock, so it is always on.
+    Snapshots are a dict (json) or prometheus text
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    COUNTERS = ("requests", "records", "bytes", "wire_bytes", "retries", "refreshes", "token_refreshes", "cache_hits", "errors")
+    TIMERS = ("duration", "ttfb", "decode", "queue_wait", "throttle_wait", "backpressure")
+
+    registry = []
+    registry_lock = Lock()
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.timers = dict.fromkeys(self.TIMERS, 0.0)
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        with Metrics.registry_lock:
+            Metrics.registry.append(self)
+
+    def unregister(self):
+        """ drops these metrics from the registry - for clients that are no longer used """
+        with Metrics.registry_lock:
+            if self in Metrics.registry:
+                Metrics.registry.remove(self)
+
+    @classmethod
+    def all(cls):
+        """ every Metrics of the process (one per customer/year) """
+        with cls.registry_lock:
+            return list(cls.registry)
+
+    def add(self, **values):
+        """ adds to counters/timers outside of a request (e.g. backpressure, token refreshes) """
+        with self.lock:
+            for name, value in values.items():
+                if name in self.counters:
+                    self.counters[name] += value
+                elif name in self.timers:
+                    self.timers[name] += value
+
+    def observe(self, **stats):
+        """ records a request - stats as collected by worker_request """
+        bucket = bisect_left(self.BUCKETS, stats.get('duration', 0))
+        with self.lock:
+            self.counters['requests'] += 1
+            self.histogram[bucket] += 1
+            for name, value in stats.items():
+                if name in self.counters:
+                    self.counters[name] += value
+                elif name in self.timers:
+                    self.timers[name] += value
+
+    def quantile(self, q, histogram):
+        """ the upper bound of the bucket holding quantile q """
+        rank = q * sum(histogram)
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else None
+        return None
+
+    def snapshot(self):
+        """ the metrics as a dict """
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict(self.timers)
+            histogram = list(self.histogram)
+        elapsed = time.time() - self.started
+        return {
+            "labels": self.labels,
+            "elapsed": round(elapsed, 3),
+            "counters": counters,
+            "seconds": {name: round(value, 6) for name, value in timers.items()},
+            "rates": {
+                "requests_per_second": round(counters['requests'] / elapsed, 3) if elapsed else 0,
+                "records_per_second": round(counters['records'] / elapsed, 3) if elapsed else 0,
+            },
+            "latency": {
+                "buckets": {str(le): count for le, count in zip(self.BUCKETS + ("+Inf",), histogram)},
+                "p50": self.quantile(0.5, histogram),
+                "p90": self.quantile(0.9, histogram),
+                "p99": self.quantile(0.99, histogram),
+            },
+        }
+
+    @staticmethod
+    def exposition(all_metrics):
+        """ prometheus text for several Metrics - the samples of a metric are grouped under its TYPE line """
+        samples = []
+        for metrics in all_metrics:
+            labels = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(metrics.labels.items()))
+            samples.append((labels, metrics.snapshot()))
+        lines = []
+        for name in Metrics.COUNTERS:
+            lines.append("# TYPE edfi_%s_total counter" % name)
+            for labels, snapshot in samples:
+                lines.append("edfi_%s_total{%s} %s" % (name, labels, snapshot['counters'][name]))
+        for name in Metrics.TIMERS:
+            lines.append("# TYPE edfi_%s_seconds_total counter" % name)
+            for labels, snapshot in samples:
+                lines.append("edfi_%s_seconds_total{%s} %s" % (name, labels, snapshot['seconds'][name]))
+        lines.append("# TYPE edfi_request_duration_seconds histogram")
+        for labels, snapshot in samples:
+            cumulative = 0
+            for le, count in snapshot['latency']['buckets'].items():
+                cumulative += count
+                lines.append('edfi_request_duration_seconds_bucket{%s%sle="%s"} %d' % (labels, "," if labels else "", le, cumulative))
+            lines.append("edfi_request_duration_seconds_sum{%s} %s" % (labels, snapshot['seconds']['duration']))
+            lines.append("edfi_request_duration_seconds_count{%s} %d" % (labels, snapshot['counters']['requests']))
+        return "\n".join(lines) + "\n"
+
+class ConcurrencyController(object):
+    """
+    Limits the number of requests in flight with AIMD (additive increase,
+    multiplicative decrease).  The limit grows by one after a full window of
+    requests (one per slot) comes back without trouble, and is cut when a
+    request fails with a throttling/server error or the smoothed latency goes
+    over latency_tolerance times the best seen - at most once per window
+    """
+    def __init__(self, max_limit, min_limit=1, latency_tolerance=2.0, decrease=0.5):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = max(self.min_limit, (self.max_limit + 1) // 2)
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.inflight = 0
+        self.window = 0
+        self.cut = False
+        self.latency = None
+        self.baseline = None
+        self.cond = Condition()
+
+    def acquire(self, blocking=True):
+        """ takes a slot, waiting for one if blocking - returns False if there was none """
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.inflight += 1
+            return True
+
+    def release(self, latency=None, ok=True):
+        """ gives back a slot with the outcome of the request """
+        with self.cond:
+            self.inflight -= 1
+            self.window += 1
+            congested = not ok
+            if ok and latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+                congested = self.latency > self.baseline * self.latency_tolerance
+            if not ok and not self.cut:
+                # errors do not wait for the end of the window
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.cut = True
+            if self.window >= self.limit:
+                if congested and not self.cut:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                elif not congested and not self.cut:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                self.window = 0
+                self.cut = False
+            self.cond.notify_all()
+
+class RateLimiter(object):
+    """ Spaces requests out to at most rate per second - shared by all workers """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = Lock()
+
+    def reserve(self):
+        """ reserves the next request slot - returns the seconds to wait for it """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+            return slot - now
+
+class TokenCache(object):
+    """
+    On disk cache of the oauth token of a customer, shared by every process
+    using the same cache folder.  The file only holds the bearer token and when
+    it expires and is readable by the owner only
+    """
+    def __init__(self, cache_dir, customer_id, baseurl, client_id):
+        key = hashlib.sha1("{}|{}".format(baseurl, client_id).encode()).hexdigest()[:12]
+        self.folder = os.path.join(cache_dir, "tokens")
+        self.filename = os.path.join(self.folder, "{}-{}.json".format(customer_id, key))
+
+    def load(self):
+        """ returns the cached token if it has not expired, else None """
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f)
+        except Exception:
+            return None
+        if cached.get('expires_at') and cached['expires_at'] <= time.time():
+            return None
+        return cached
+
+    def save(self, access_token, expires_at, margin=None):
+        """ saves the token with how long before expiry it is refreshed """
+        os.makedirs(self.folder, exist_ok=True)
+        tmpname = self.filename + ".tmp"
+        with os.fdopen(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"access_token": access_token, "expires_at": expires_at, "margin": margin}, f)
+        os.replace(tmpname, self.filename)
+
+    @contextmanager
+    def lock(self):
+        """ cross process lock around a refresh - a no-op where fcntl is not available """
+        if not fcntl:
+            yield
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.filename + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class MetadataCache(object):
+    """
+    On disk cache of metadata documents, keyed by customer, base url and api
+    version.  A document is kept as json, with a small json sidecar for when
+    it was fetched and its ETag/Last-Modified - only the sidecar is rewritten
+    when a revalidation finds the document unchanged
+    """
+    def __init__(self, cache_dir, customer_id, baseurl, api_ver):
+        key = hashlib.sha1("{}|{}".format(baseurl, api_ver).encode()).hexdigest()[:12]
+        self.folder = os.path.join(cache_dir, "metadata", "{}-{}".format(customer_id, key))
+
+    def _filename(self, url, suffix):
+        return os.path.join(self.folder, hashlib.sha1(url.encode()).hexdigest() + suffix)
+
+    @staticmethod
+    def _read(filename):
+        with open(filename) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write(filename, value):
+        with open(filename + ".tmp", "w") as f:
+            json.dump(value, f)
+        os.replace(filename + ".tmp", filename)
+
+    def load(self, url):
+        """ returns the cache entry for a url, None if not cached """
+        try:
+            entry = self._read(self._filename(url, ".meta.json"))
+            entry['data'] = self._read(self._filename(url, ".json"))
+        except Exception:
+            return None
+        return entry
+
+    def save(self, url, entry):
+        """ saves the cache entry for a url - the document before its sidecar """
+        os.makedirs(self.folder, exist_ok=True)
+        meta = {k: v for k, v in entry.items() if k != "data"}
+        try:
+            saved = self._read(self._filename(url, ".meta.json"))
+        except Exception:
+            saved = None
+        if saved is None or saved.get('downloaded') != meta.get('downloaded') or saved.get('source') != meta.get('source') or \
+                not os.path.exists(self._filename(url, ".json")):
+            self._write(self._filename(url, ".json"), entry.get('data'))
+        self._write(self._filename(url, ".meta.json"), meta)
+
+class PageCache(object):
+    """
+    On disk (sqlite) cache of api responses - pages, records and counts -
+    keyed by customer and url, shared by every process using the same cache
+    folder.  Entries are served for the ttl they are loaded with, the least
+    recently used are evicted once the bodies total more than max_bytes
+    """
+    HEADERS = ("Content-Type", "Total-Count") # the response headers kept
+
+    def __init__(self, filename, max_bytes):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, size INTEGER, stored REAL, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def load(self, customer_id, url, ttl):
+        """ (status, headers, body) cached for url if stored less than ttl seconds ago, else None """
+        key = "{}|{}".format(customer_id, url)
+        with self.lock:
+            row = self.db.execute("SELECT status, headers, body, stored FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[3] > ttl:
+                return None
+            self.db.execute("UPDATE pages SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0], json.loads(row[1]), row[2]
+
+    def save(self, customer_id, url, status, headers, body):
+        """ caches a response, evicting the least recently used over max_bytes """
+        key = "{}|{}".format(customer_id, url)
+        headers = json.dumps({name: headers[name] for name in self.HEADERS if name in headers})
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", (key, status, headers, body, len(body), now, now))
+            self.size += len(body) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ drops the least recently used entries down to 90% of max_bytes - called with the lock held """
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0] # other processes write too
+        target = self.max_bytes * 0.9
+        if self.size <= target:
+            return
+        keys = []
+        for key, size in self.db.execute("SELECT key, size FROM pages ORDER BY used"):
+            keys.append((key,))
+            self.size -= size
+            if self.size <= target:
                 break
-        return n
-        
+        self.db.executemany("DELETE FROM pages WHERE key = ?", keys)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def cached_response(url, entry):
+    """ a requests Response for a (status, headers, body) page cache entry """
+    res = requests.Response()
+    res.status_code, headers, res._content = entry
+    res.headers.update(headers)
+    res.url = url
+    return res
+
+COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd"}
+
+def open_input(filename):
+    """ opens a file for reading text - gzip, bz2, xz and zstd (if zstandard is installed) by their extension """
+    compression = COMPRESSIONS.get(os.path.splitext(filename)[1])
+    if compression == "gzip":
+        return gzip.open(filename, "rt", encoding="utf-8")
+    if compression == "bz2":
+        return bz2.open(filename, "rt", encoding="utf-8")
+    if compression == "xz":
+        return lzma.open(filename, "rt", encoding="utf-8")
+    if compression == "zstd":
+        if not zstandard:
+            raise Exception("%s needs zstandard - pip3 install zstandard" % filename)
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True), encoding="utf-8")
+    return open(filename, encoding="utf-8")
+
+def open_output(filename, compression=None):
+    """
+    opens a file for writing text - compressed with gzip or zstd (needs
+    zstandard) as it is written, so large outputs never sit uncompressed
+    """
+    if compression == "gzip":
+        return gzip.open(filename, "wt", encoding="utf-8", compresslevel=6)
+    if compression == "zstd":
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=3).stream_writer(open(filename, "wb"), closefd=True), encoding="utf-8")
+    return open(filename, "w")
+
+class LazyOutput(object):
+    """
+    An open_output file that is only opened when first used, as
+    click.utils.LazyFile - nothing is created for an output never written to
+    """
+    def __init__(self, filename, compression=None):
+        self.name = filename
+        self.compression = compression
+        self.file = None
+
+    def __getattr__(self, name):
+        if self.file is None:
+            self.file = open_output(self.name, self.compression)
+        return getattr(self.file, name)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def check_compress(compression, fmt):
+    """ raises a UsageError if the --compress option can not be used """
+    if compression and fmt == "parquet":
+        raise click.UsageError("--compress does not apply to parquet, it is compressed already")
+    if compression == "zstd" and not zstandard:
+        raise click.UsageError("--compress=zstd needs zstandard - pip3 install zstandard")
+
+def compressed_name(filename, compression):
+    """ filename with the extension of the compression, if it does not have it """
+    extension = {name: ext for ext, name in COMPRESSIONS.items()}.get(compression, "")
+    return filename if filename.endswith(extension) else filename + extension
+
+def json_indent(cfg):
+    """ the indent of json written to files - the config's json_indent, compact (None) by default """
+    try:
+        return int(cfg.get('general', {})['json_indent']) or None
+    except:
+        return None
+
+def iter_json_records(f, chunk_size=1 << 20):
+    """
+    yields the records of json output read from f a chunk at a time - a json
+    array (any indent), ndjson or a json array per line (raw-pages) - without
+    holding the whole file
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    in_array = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+        if pos < len(buf) and buf[pos] in "[,]":
+            if buf[pos] == "[" and not in_array:
+                in_array = True
+            elif buf[pos] == "]" and in_array:
+                in_array = False
+            elif buf[pos] != "," or not in_array:
+                raise ValueError("Unexpected %r in json input" % buf[pos])
+            pos += 1
+            continue
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                value = end = None
+            if end is not None and (end < len(buf) or eof):
+                pos = end
+                if isinstance(value, list):
+                    yield from value
+                else:
+                    yield value
+                continue
+        if eof:
+            if in_array:
+                raise ValueError("Unterminated json array in input")
+            return
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+class LocalStore(object):
+    """
+    Local sqlite copy of extracted endpoints, for lookups without the api.
+    Each customer, year and endpoint has a table of its records as json, with
+    the record id and key fields (the endpoint's ids and those of its
+    references) as indexed columns
+    """
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS endpoints (customer TEXT, year TEXT, endpoint TEXT, tbl TEXT, keys TEXT, records INTEGER, indexed REAL, PRIMARY KEY (customer, year, endpoint))")
+
+    @staticmethod
+    def quote(name):
+        """ a quoted sqlite identifier """
+        return '"{}"'.format(name.replace('"', '""'))
+
+    @staticmethod
+    def key_fields(structure):
+        """ {field: column} of the key fields of a structure - the fields named ...Id """
+        return {field: column for field, column in query_fields(structure).items() if field.endswith("Id")}
+
+    def load(self, customer_id, year, endpoint, records, keys, batch_size=5000):
+        """
+        replaces the endpoint's table with records - keys is {field: column}
+        of the key fields to index.  A record id seen again replaces the
+        earlier record.  Returns the number of records
+        """
+        table = "{}/{}/{}".format(customer_id, year, endpoint)
+        getters = [Flattener._compile(Flattener.column_path(column), False) for column in keys.values()]
+        columns = "".join(", {} TEXT".format(self.quote(field)) for field in keys)
+        insert = "INSERT OR REPLACE INTO {} VALUES (?, ?{})".format(self.quote(table), ", ?" * len(keys))
+        db = self.db
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("BEGIN")
+        try:
+            db.execute("DROP TABLE IF EXISTS {}".format(self.quote(table)))
+            db.execute("CREATE TABLE {} (id TEXT UNIQUE, record TEXT{})".format(self.quote(table), columns))
+            rows = []
+            for record in records:
+                rows.append([record.get('id'), json.dumps(record, separators=(",", ":"))] + [getter(record) for getter in getters])
+                if len(rows) >= batch_size:
+                    db.executemany(insert, rows)
+                    rows = []
+            db.executemany(insert, rows)
+            count = db.execute("SELECT COUNT(*) FROM {}".format(self.quote(table))).fetchone()[0]
+            for field in keys: # after the load - building an index once is faster than keeping it up to date
+                db.execute("CREATE INDEX {} ON {} ({})".format(self.quote(table + "/" + field), self.quote(table), self.quote(field)))
+            db.execute("INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (customer_id, str(year), endpoint, table, json.dumps(keys), count, time.time()))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.execute("PRAGMA synchronous=FULL")
+        return count
+
+    def endpoints(self, customer_id, year):
+        """ the endpoints indexed for a customer and year """
+        return [row[0] for row in self.db.execute("SELECT endpoint FROM endpoints WHERE customer = ? AND year = ? ORDER BY endpoint", (customer_id, str(year)))]
+
+    def table(self, customer_id, year, endpoint):
+        """ (table, key fields) of an indexed endpoint """
+        row = self.db.execute("SELECT tbl, keys FROM endpoints WHERE customer = ? AND year = ? AND endpoint = ?", (customer_id, str(year), endpoint)).fetchone()
+        if row is None:
+            raise Exception("%s is not indexed for %s %s - see the index command" % (endpoint, customer_id, year))
+        return self.quote(row[0]), json.loads(row[1])
+
+    def get(self, customer_id, year, endpoint, record_id):
+        """ the record with an id, None if there is none """
+        table, keys = self.table(customer_id, year, endpoint)
+        row = self.db.execute("SELECT record FROM {} WHERE id = ?".format(table), (record_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self, customer_id, year, endpoint):
+        """ the number of records of an endpoint """
+        table, keys = self.table(customer_id, year, endpoint)
+        return self.db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+    def query(self, customer_id, year, endpoint, conditions, limit=None):
+        """
+        yields the records matching every (field, value) of conditions - key
+        fields use their index, any other field is a column name
+        (schoolReference_schoolId) read from the json
+        """
+        table, keys = self.table(customer_id, year, endpoint)
+        where = []
+        args = []
+        for field, value in conditions:
+            if field in keys or field == "id":
+                where.append("{} = ?".format(self.quote(field)))
+            else:
+                where.append("CAST(json_extract(record, ?) AS TEXT) = ?")
+                args.append("$." + ".".join(self.quote(key) for key in Flattener.column_path(field)))
+            args.append(value)
+        sql = "SELECT record FROM {}".format(table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if limit:
+            sql += " LIMIT {:d}".format(limit)
+        for row in self.db.execute(sql, args):
+            yield json.loads(row[0])
+
+class Checkpoint(object):
+    """
+    Checkpoint of a get --page=-1 --checkpoint run: each page fetched is saved
+    to <output>.parts/<offset>.json (compressed as the output is) and its offset
+    appended to the journal <output>.journal.  A resumed run only fetches the
+    offsets not in the journal, and the output is put together from the parts
+    in offset order
+    """
+    def __init__(self, output_name, endpoint, limit, resume=False, raw=False, options=None, compression=None):
+        self.journal = output_name + ".journal"
+        self.folder = output_name + ".parts"
+        self.raw = raw
+        self.compression = compression
+        self.done = set()
+        header = {"endpoint": endpoint, "limit": limit}
+        if raw:
+            header['raw'] = True
+        if compression:
+            header['compress'] = compression
+        header.update(options or {}) # e.g. filters - a resumed run must use the same
+        if resume and os.path.exists(self.journal):
+            with open(self.journal) as f:
+                lines = f.read().splitlines()
+            if not lines or json.loads(lines[0]) != header:
+                raise Exception("Checkpoint %s is not for %s with limit %d%s and these options" % (self.journal, endpoint, limit, " (raw)" if raw else ""))
+            for line in lines[1:]:
+                try:
+                    self.done.add(json.loads(line)['offset'])
+                except ValueError:
+                    break # partly written line from a crash
+        else:
+            self.remove()
+            os.makedirs(self.folder)
+            with open(self.journal, "w") as f:
+                f.write(json.dumps(header) + "\n")
+        self.lock = Lock()
+        self.f = open(self.journal, "a")
+
+    def has(self, offset):
+        """ true if the page at offset was already fetched """
+        return offset in self.done
+
+    def part(self, offset):
+        """ the file of the page at offset """
+        return compressed_name(os.path.join(self.folder, "{}.json".format(offset)), self.compression)
+
+    def save(self, offset, records):
+        """ saves a page and journals it - the journal line is only written once the page is on disk """
+        filename = self.part(offset)
+        with open_output(filename + ".tmp", self.compression) as f:
+            if isinstance(records, RawPage):
+                f.write(records.body.decode("utf-8"))
+            else:
+                json.dump(records, f)
+        os.replace(filename + ".tmp", filename)
+        with self.lock:
+            self.f.write(json.dumps({"offset": offset, "count": None if self.raw else len(records)}) + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.done.add(offset)
+
+    def pages(self):
+        """ yields the saved pages in offset order """
+        for offset in sorted(self.done):
+            with open_input(self.part(offset)) as f:
+                if self.raw:
+                    yield RawPage(f.read().encode("utf-8"))
+                else:
+                    yield json.load(f)
+
+    def remove(self):
+        """ removes the journal and parts """
+        if getattr(self, "f", None):
+            self.f.close()
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+class SyncState(object):
+    """
+    Manages the change version watermarks of the sync command - stored per
+    customer, year and endpoint in a json file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.state = json.load(f)
+
+    def get(self, customer_id, year, endpoint):
+        """ returns the last change version synced, None if never synced """
+        return self.state.get(customer_id, {}).get(str(year), {}).get(endpoint)
+
+    def set(self, customer_id, year, endpoint, version):
+        """ records the change version synced and saves the state """
+        self.state.setdefault(customer_id, {}).setdefault(str(year), {})[endpoint] = version
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmpname, self.filename)
+
+class FanOut(object):
+    """
+    EdFi instances for several customer/year targets run in one process.  The
+    years of a customer share one instance's token (see EdFi.for_year) and
+    the customers whose api is on the same host share one
+    ConcurrencyController, so no host has more than its host_concurrency
+    requests in flight whichever targets they come from
+    """
+    def __init__(self, targets):
+        self.instances = {}
+        self.throttles = {}
+        customers = {}
+        for customer_id, year in targets:
+            if customer_id not in customers:
+                customers[customer_id] = EdFi(year=year, customer_id=customer_id)
+                edfi = customers[customer_id]
+            else:
+                edfi = customers[customer_id].for_year(year)
+            self.instances[(customer_id, year)] = edfi
+
+        limits = {}
+        for edfi in customers.values():
+            host = self.host(edfi)
+            limits[host] = min(limits.get(host, edfi.host_concurrency), edfi.host_concurrency)
+        adaptive = all(edfi.general_setting('adaptive_concurrency', True) for edfi in customers.values())
+        for host, limit in limits.items():
+            self.throttles[host] = ConcurrencyController(limit, min_limit=1 if adaptive else limit)
+        for edfi in self.instances.values():
+            # for_year copies were made before this - set it on each of them
+            edfi.throttle = self.throttles[self.host(edfi)]
+
+    def close(self):
+        """
+        closes the instances when serving, so the daemon does not keep them - else
+        they stay open for the metrics written at exit
+        """
+        if CommandServer.clients is None:
+            return
+        for edfi in self.instances.values():
+            edfi.metrics.unregister()
+        for edfi in {id(edfi.session): edfi for edfi in self.instances.values()}.values():
+            edfi.close() # once per customer, its years share the session and caches
+
+    @staticmethod
+    def host(edfi):
+        """ the host (and port) of an instance's api """
+        return urlparse(edfi.baseurl).netloc.lower()
+
+    @staticmethod
+    def targets(config, pairs, all_customers=False, year=None):
+        """
+        [(customer_id, year)] from CUSTOMER[:YEAR] strings, or every customer
+        section of the config with all_customers.  The year is year, else the
+        customer's default_year
+        """
+        if all_customers:
+            pairs = list(pairs) + [name for name, section in config.items() if name != "general" and isinstance(section, dict)]
+        targets = []
+        for pair in pairs:
+            customer_id, _, pair_year = pair.partition(":")
+            pair_year = pair_year or year or config.get(customer_id, {}).get('default_year')
+            if not pair_year:
+                raise click.UsageError("No year for %s - use %s:YEAR, --year or set default_year" % (customer_id, customer_id))
+            if (customer_id, str(pair_year)) not in targets:
+                targets.append((customer_id, str(pair_year)))
+        return targets
+
+class FrameWriter(io.RawIOBase):
+    """ writes to a serve client's socket as frames of one channel - a byte for the channel and a 4 byte length """
+    def __init__(self, conn, channel):
+        self.conn = conn
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self.conn.sendall(self.channel + struct.pack(">I", len(data)) + bytes(data))
+        return len(data)
+
+class CommandServer(object):
+    """
+    Runs the commands forwarded by forward_to_server, one at a time, in this
+    process - in the client's folder, with an empty stdin and with stdout/stderr
+    sent back as frames.  The EdFi clients (pooled session, token, parsed
+    swagger) are kept between commands, per config file, customer and year
+    """
+    clients = None # {(config file, mtime, customer, year): EdFi} while serving
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.lock = Lock()
+
+    @classmethod
+    def client(cls, year, customer_id):
+        """ the warm EdFi for the customer/year when serving, else a new one """
+        if cls.clients is None:
+            return EdFi(year=year, customer_id=customer_id)
+        config = os.path.realpath("config.toml")
+        key = (config, os.path.getmtime(config) if os.path.exists(config) else None, customer_id, str(year))
+        if key not in cls.clients:
+            for old in [k for k in cls.clients if k[0] == config and k[1] != key[1]]:
+                cls.clients.pop(old).close() # config changed
+            cls.clients[key] = EdFi(year=year, customer_id=customer_id)
+        return cls.clients[key]
+
+    def serve(self):
+        """ listens until interrupted - in a folder only this user can use """
+        folder = os.path.dirname(os.path.abspath(self.socket_path))
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        st = os.stat(folder)
+        # others must not be able to swap the socket - a folder of ours they can not write, or a sticky one (/tmp)
+        if not (st.st_uid == os.getuid() and not st.st_mode & 0o022) and not st.st_mode & stat.S_ISVTX:
+            raise click.ClickException("%s can be written by other users - use a folder of your own for the socket" % folder)
+        if os.path.lexists(self.socket_path):
+            if not private_path(self.socket_path):
+                raise click.ClickException("%s is not a socket of this user's - not replacing it" % self.socket_path)
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177) # the socket is only for this user
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        CommandServer.clients = {}
+        try:
+            while True:
+                conn, _ = listener.accept()
+                Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+
+    def handle(self, conn):
+        """ reads a request and runs it once no other command is running """
+        try:
+            if peer_uid(conn) not in (None, os.getuid()):
+                return # another user's process
+            request = json.loads(conn.makefile("rb").readline())
+            with self.lock:
+                code = self.run(request, conn)
+            conn.sendall(b"x" + struct.pack(">I", len(str(code))) + str(code).encode())
+        except Exception:
+            pass # client went away
+        finally:
+            conn.close()
+
+    def run(self, request, conn):
+        """ runs a command line in the client's folder - returns the exit code """
+        argv = request['argv']
+        if argv and argv[0] == "serve":
+            return 2
+        saved = sys.stdin, sys.stdout, sys.stderr, os.getcwd()
+        stdout = io.TextIOWrapper(io.BufferedWriter(FrameWriter(conn, b"o"), 65536), encoding="utf-8", write_through=True)
+        stderr = io.TextIOWrapper(io.BufferedWriter(FrameWriter(conn, b"e"), 4096), encoding="utf-8", write_through=True, line_buffering=True)
+        sys.stdin = io.StringIO() # commands reading stdin are not forwarded
+        sys.stdout, sys.stderr = stdout, stderr
+        code = 0
+        try:
+            os.chdir(request['cwd'])
+            cli.main(args=argv, prog_name="edfi.py", standalone_mode=False, color=request.get('color') or None)
+        except SystemExit as exp:
+            code = exp.code if isinstance(exp.code, int) else (0 if exp.code is None else 1)
+            if exp.code is not None and not isinstance(exp.code, int):
+                stderr.write("%s\n" % exp.code)
+        except click.exceptions.Exit as exp:
+            code = exp.exit_code
+        except click.ClickException as exp:
+            exp.show(file=stderr)
+            code = exp.exit_code
+        except (click.exceptions.Abort, KeyboardInterrupt):
+            stderr.write("Aborted!\n")
+            code = 1
+        except Exception as exp:
+            stderr.write("Error - %s\n" % exp)
+            code = 1
+        finally:
+            try:
+                stdout.flush()
+                stderr.flush()
+            except Exception:
+                pass
+            sys.stdin, sys.stdout, sys.stderr = saved[:3]
+            os.chdir(saved[3])
+        return code
+
 FAIL = "red"
 PASS = "green"
 INFO = "blue"
-def echo(msg, mode):
-    """ very thin wrapper around click echo """
-    click.echo(click.style(msg, fg=mode))
+def echo(msg, mode, err=False):
+    """ very thin wrapper around click echo - err writes to stderr """
+    click.echo(click.style(msg, fg=mode), err=err)
+
+def endpoint_args(args, all_endpoints):
+    """ splits [ENDPOINT] CUSTOMERID YEAR arguments - no ENDPOINT when all_endpoints """
+    if len(args) != (2 if all_endpoints else 3):
+        raise click.UsageError("expected %s" % ("CUSTOMERID YEAR" if all_endpoints else "ENDPOINT CUSTOMERID YEAR"))
+    if all_endpoints:
+        return (None, ) + tuple(args)
+    return tuple(args)
+
+def local_store():
+    """ the LocalStore in the config's local_store file """
+    return LocalStore(Config().config.get('general', {}).get('local_store', 'local_store.sqlite'))
+
+def query_fields(structure):
+    """
+    {field: column} of the fields of an endpoint that can be filtered on - its
+    properties and the keys of its references (schoolId for
+    schoolReference_schoolId), a property wins over a reference key.  The
+    api's own fields (_etag) are not filters
+    """
+    fields = {}
+    for column, kind in structure.items():
+        path = Flattener.column_path(column)
+        if column.startswith("_") or isinstance(kind, dict) or not (len(path) == 1 or (len(path) == 2 and path[0].endswith("Reference"))):
+            continue
+        if len(path) == 1 or path[-1] not in fields:
+            fields[path[-1]] = column
+    return fields
+
+def split_conditions(conditions):
+    """ (field, value) pairs of field=value --where conditions """
+    pairs = []
+    for condition in conditions:
+        field, sep, value = condition.partition("=")
+        field = field.strip()
+        if not sep or not field:
+            raise click.BadParameter("%s is not field=value" % condition, param_hint="--where")
+        pairs.append((field, value))
+    return pairs
+
+def where_params(structure, conditions):
+    """
+    query parameters from field=value --where conditions - the field must be a
+    property of the endpoint (in its structure) or a key of one of its
+    references, by name (schoolId) or column (schoolReference_schoolId)
+    """
+    fields = query_fields(structure)
+    names = {column: path[-1] for column, path in ((c, Flattener.column_path(c)) for c in structure)
+             if len(path) == 2 and path[0].endswith("Reference") and path[-1] in fields}
+    params = {}
+    for field, value in split_conditions(conditions):
+        field = names.get(field, field) # the api filters schoolReference_schoolId as schoolId
+        column = fields.get(field)
+        if not column:
+            raise click.BadParameter("%s can not be filtered on - one of %s" % (field, ", ".join(sorted(fields))), param_hint="--where")
+        if structure[column] == "integer":
+            try:
+                int(value)
+            except ValueError:
+                raise click.BadParameter("%s must be an integer" % field, param_hint="--where")
+        params[field] = value
+    return params
 
 # ####
 # CLI commands
@@ -510,80 +3072,319 @@ def cli():
 @click.option("--output", default=None, type=click.File('w'))
 @click.option("--page", type=int, default=0, help="Get page by number (limit of 50), -1 for all")
 @click.option("--limit", type=int, default=50, help="Number of records per page")
-def get(endpoint, customerid, year, output, page, limit):
-    """ gets the data from an endpoint """
+@click.option("--format", "fmt", type=click.Choice(OUTPUT_FORMATS), default="json", help="Write a json array, one record per line or rows flattened to the endpoint's structure")
+@click.option("--checkpoint", is_flag=True, help="Save the pages of a --page=-1 --output run as they arrive, so an interrupted run can be resumed")
+@click.option("--resume", is_flag=True, help="Continue an interrupted --checkpoint run, only getting the pages it is missing")
+@click.option("--where", "conditions", multiple=True, metavar="FIELD=VALUE", help="Only records with this value, filtered by the api - may be repeated")
+@click.option("--fields", default=None, metavar="A,B,C", help="Only keep these fields of the records")
+@click.option("--no-cache", is_flag=True, help="Do not use the page cache")
+@click.option("--refresh", is_flag=True, help="Get everything from the api again and update the page cache")
+@click.option("--indent", type=int, default=None, help="Indent json by this many spaces, 0 for compact - defaults to compact for --output (json_indent) and 4 otherwise")
+@click.option("--compress", default=None, type=click.Choice(["gzip", "zstd"]), help="Compress --output as it is written, adding .gz/.zst to its name (zstd needs zstandard)")
+def get(endpoint, customerid, year, output, page, limit, fmt, checkpoint, resume, conditions, fields, no_cache, refresh, indent, compress):
+    """
+    gets the data from an endpoint - pages are written in order as they arrive,
+    or with --checkpoint (--page=-1 and --output) saved to <output>.parts and
+    written once all pages are in.  The raw formats write the pages as received, without
+    decoding them: raw as one json array, raw-pages a page's array per line.
+    --where filters and --fields names are checked against the endpoint's
+    structure.  Pages are served from the page cache, if configured
+    """
     start = time.time()
-    data = None
-    edfi = EdFi(year=year, customer_id=customerid)
+    checkpoint = checkpoint or resume
+    if checkpoint and not (output and page == -1):
+        raise click.UsageError("--checkpoint and --resume need --page=-1 and --output")
+    if fmt == "parquet" and not output:
+        raise click.UsageError("--format=parquet needs --output")
+    if compress and not output:
+        raise click.UsageError("--compress needs --output")
+    check_compress(compress, fmt)
+    raw = fmt in RAW_FORMATS
+    if raw and fields:
+        raise click.UsageError("--fields needs the records decoded - not with the raw formats")
+    edfi = CommandServer.client(year, customerid)
+    params = None
+    if conditions or fields:
+        structure = edfi.structure(endpoint)
+        params = where_params(structure, conditions) or None
+        fields = Projection.parse(fields, structure) if fields else None
+    if indent is None:
+        indent = json_indent(edfi.cfg) if output else 4
+    out = output or click.get_text_stream('stdout')
+    out_name = output.name if output else None
+    if compress:
+        out_name = compressed_name(output.name, compress)
+        out = LazyOutput(out_name, compress)
+    saved = None
     try:
-        data = edfi.get(endpoint, page, limit)
-    except Exception as exp:
-        echo("Could not get data for %s - %s" % (endpoint, exp), FAIL)
+        writer = build_writer(edfi, endpoint, fmt, out, fields, indent)
+        with edfi.caching(no_cache, refresh):
+            if checkpoint:
+                options = {}
+                if params:
+                    options['where'] = params
+                if fields:
+                    options['fields'] = fields.fields
+                saved = Checkpoint(output.name, endpoint, limit, resume, raw, options, compress)
+                for offset, records in edfi.iter_pages(endpoint, page, limit, skip=saved.has, raw=raw, params=params, fields=fields):
+                    saved.save(offset, records)
+                for records in saved.pages():
+                    writer.write(records)
+                writer.close()
+                saved.remove()
+            else:
+                for offset, records in edfi.iter_pages(endpoint, page, limit, raw=raw, params=params, fields=fields):
+                    writer.write(records)
+                writer.close()
+        if compress:
+            out.close()
+    except (Exception, KeyboardInterrupt) as exp:
+        echo("Could not get data for %s - %s" % (endpoint, str(exp) or "interrupted"), FAIL)
+        if saved and saved.done:
+            echo("%d pages are checkpointed, rerun with --resume to get the rest" % len(saved.done), INFO)
         sys.exit(1)
-    if not data:
+    if not writer.count:
         echo("No data returned for endpoint %s" % endpoint, INFO)
         sys.exit(1)
     if output:
-        json.dump(data, output, indent=4)
-        echo("Wrote %s records from %s to %s" %(len(data), endpoint, output.name), PASS)
-    else:
-        echo(json.dumps(data, indent=4), PASS)
-    edfi.profile("get %s (count: %d)" % (endpoint, len(data)), time.time()-start)
+        echo("Wrote %s %s from %s to %s" %(writer.count, "pages" if raw else "records", endpoint, out_name), PASS)
+    elif fmt in ("json", "raw"):
+        # ends the array's line - the line formats already end each line
+        click.echo()
+    edfi.profile("get %s (%s: %d)" % (endpoint, "pages" if raw else "count", writer.count), time.time()-start)
+    edfi.profile_connections()
 
 @cli.command()
-@click.argument("endpoint")
-@click.argument("customerid")
-@click.argument("year")
-def structure(endpoint, customerid, year):
+@click.argument("args", nargs=-1, required=True, metavar="[ENDPOINT] CUSTOMERID YEAR")
+@click.option("--all", "structure_all", is_flag=True, help="Structures of every endpoint (no ENDPOINT)")
+def structure(args, structure_all):
     """ gets the structure from an endpoint """
-    edfi = EdFi(year=year, customer_id=customerid)
+    endpoint, customerid, year = endpoint_args(args, structure_all)
+    edfi = CommandServer.client(year, customerid)
     try:
-        echo(json.dumps(edfi.structure(endpoint), indent=4), PASS)
+        echo(json.dumps(edfi.structures() if structure_all else edfi.structure(endpoint), indent=4), PASS)
+    except AuthError:
+        raise
     except Exception as exp:
-        echo("Could not get structure for %s - %s" % (endpoint, exp), FAIL)
+        echo("Could not get structure for %s - %s" % (endpoint or "all endpoints", exp), FAIL)
 
 @cli.command()
-@click.argument("endpoint")
-@click.argument("customerid")
-@click.argument("year")
-def count(endpoint, customerid, year):
-    """ counts the return data from an endpoint """
-    edfi = EdFi(year=year, customer_id=customerid)
-
-    try:
-        echo("{} - {}".format(endpoint, edfi.get_count(endpoint=endpoint)), PASS)
-    except Exception as exp:
-        echo("{} - error - {}".format(endpoint, exp), FAIL)
+@click.argument("args", nargs=-1, required=True, metavar="[ENDPOINT] CUSTOMERID YEAR")
+@click.option("--all", "count_all", is_flag=True, help="Count every endpoint from getendpoints at once (no ENDPOINT)")
+@click.option("--no-cache", is_flag=True, help="Do not use the page cache")
+@click.option("--refresh", is_flag=True, help="Get everything from the api again and update the page cache")
+@click.option("--local", is_flag=True, help="Count the records in the local store (see index) instead of the api")
+def count(args, count_all, no_cache, refresh, local):
+    """ counts the return data from an endpoint - counts are served from the page cache, if configured """
+    endpoint, customerid, year = endpoint_args(args, count_all)
+    if local:
+        store = local_store()
+        for endpoint in store.endpoints(customerid, year) if count_all else [endpoint]:
+            try:
+                echo("{} - {}".format(endpoint, store.count(customerid, year, endpoint)), PASS)
+            except Exception as exp:
+                echo("{} - error - {}".format(endpoint, exp), FAIL)
+        return
+    edfi = CommandServer.client(year, customerid)
+
+    endpoints = edfi.get_endpoints() if count_all else [endpoint]
+    with edfi.caching(no_cache, refresh), ThreadPoolExecutor(max_workers=edfi.max_workers) as pool:
+        # with several endpoints the pool runs them concurrently and each is probed serially
+        futures = {pool.submit(edfi.get_count, endpoint=endpoint, concurrent=len(endpoints) == 1): endpoint for endpoint in endpoints}
+        for future in as_completed(futures):
+            try:
+                echo("{} - {}".format(futures[future], future.result()), PASS)
+            except AuthError:
+                raise
+            except Exception as exp:
+                echo("{} - error - {}".format(futures[future], exp), FAIL)
+    edfi.profile_connections()
 
 @cli.command()
 @click.argument("endpoint")
 @click.argument("record_id")
 @click.argument("customerid")
 @click.argument("year")
-def getrecord(endpoint, record_id, customerid, year):
+@click.option("--no-cache", is_flag=True, help="Do not use the page cache")
+@click.option("--refresh", is_flag=True, help="Get everything from the api again and update the page cache")
+@click.option("--local", is_flag=True, help="Get the record from the local store (see index) instead of the api")
+def getrecord(endpoint, record_id, customerid, year, no_cache, refresh, local):
     """
-    Gets a record from an endpoint by record id
+    Gets a record from an endpoint by record id - served from the page cache,
+    if configured
     @endpoint : the endpoint
     @record_id : the record id
     @returns : dictionary for the record
     """
-    edfi = EdFi(year=year, customer_id=customerid)
-
     try:
-        record = edfi.get_record(endpoint, record_id)
+        if local:
+            record = local_store().get(customerid, year, endpoint, record_id)
+        else:
+            edfi = CommandServer.client(year, customerid)
+            with edfi.caching(no_cache, refresh):
+                record = edfi.get_record(endpoint, record_id)
         if record:
             echo(json.dumps(record, indent=4), PASS)
         else:
             echo("No data returned for %s from %s" % (record_id, endpoint), FAIL)
+    except AuthError:
+        raise
     except Exception as exp:
         echo("Error trying to retrieve %s from %s - %s" % (record_id, endpoint, exp), FAIL)
-    
+
+@cli.command()
+@click.argument("endpoint")
+@click.argument("customerid")
+@click.argument("year")
+@click.option("--ids", "ids_file", default="-", type=click.File('r'), help="File with a record id per line, - for stdin (default)")
+@click.option("--output", default=None, type=click.File('w'), help="File to write the results to, defaults to stdout")
+def getrecords(endpoint, customerid, year, ids_file, output):
+    """
+    Gets records from an endpoint by id - the ids are read from a file or
+    stdin and fetched concurrently.  Written as ndjson in the order of the ids,
+    a line per id with its status: {"id", "status", "record"} when found,
+    {"id", "status": 404} when not, {"id", "status": null, "error"} when the
+    request failed
+    """
+    start = time.time()
+    edfi = CommandServer.client(year, customerid)
+    out = output or click.get_text_stream('stdout')
+    ids = (line.strip() for line in ids_file if line.strip())
+    counts = {"found": 0, "missing": 0, "failed": 0}
+    try:
+        for record_id, status, record, error in edfi.iter_records(endpoint, ids):
+            line = {"id": record_id, "status": status}
+            if record is not None:
+                line['record'] = record
+                counts['found'] += 1
+            elif error:
+                line['error'] = error
+                counts['failed'] += 1
+            else:
+                counts['missing'] += 1
+            out.write(json.dumps(line) + "\n")
+            if not output:
+                out.flush() # stream the lines to whatever reads stdout
+    except KeyboardInterrupt:
+        echo("Interrupted", FAIL, err=True)
+        sys.exit(1)
+    out.flush()
+    summary = "%s - %d found, %d not found, %d failed" % (endpoint, counts['found'], counts['missing'], counts['failed'])
+    echo(summary, FAIL if counts['failed'] else PASS, err=not output)
+    edfi.profile("getrecords %s (found: %d, missing: %d, failed: %d)" % (endpoint, counts['found'], counts['missing'], counts['failed']), time.time()-start)
+    edfi.profile_connections()
+    if counts['failed']:
+        sys.exit(1)
+
+@cli.command()
+@click.argument("customerid")
+@click.argument("year")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--endpoint", default=None, help="Endpoint of the files - defaults to their names (<endpoint>.json)")
+def index(customerid, year, paths, endpoint):
+    """
+    loads get/extract output into the local store (local_store file) for
+    getrecord --local, count --local and query.  PATHS are json or ndjson
+    files, optionally compressed (.gz, .bz2, .xz, .zst), or folders of them
+    (sync's .deletes files are skipped).  The files of an endpoint replace
+    what was indexed for it before
+    """
+    start = time.time()
+    files = {}
+    for path in paths:
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for name in names:
+            base = os.path.basename(name)
+            if os.path.splitext(base)[1] in COMPRESSIONS:
+                base = os.path.splitext(base)[0]
+            if os.path.splitext(base)[1] not in (".json", ".ndjson"):
+                if not os.path.isdir(path):
+                    echo("%s is not json or ndjson - skipped" % name, FAIL)
+                continue
+            if base.split(".")[1:2] == ["deletes"]:
+                # sync's <endpoint>.deletes.* files hold deleted records, not ones to look up
+                if not os.path.isdir(path):
+                    echo("%s has deleted records - skipped" % name, INFO)
+                continue
+            files.setdefault(endpoint or base.split(".")[0], []).append(name)
+    if not files:
+        raise click.UsageError("No json or ndjson files in %s" % ", ".join(paths))
+
+    edfi = CommandServer.client(year, customerid)
+    store = local_store()
+    total = 0
+    failed = 0
+    for name, filenames in sorted(files.items()):
+        try:
+            keys = LocalStore.key_fields(edfi.structure(name))
+        except AuthError:
+            raise
+        except Exception as exp:
+            echo("%s - no structure, only id is indexed - %s" % (name, exp), INFO)
+            keys = {}
+
+        def records():
+            for filename in filenames:
+                with open_input(filename) as f:
+                    yield from iter_json_records(f)
+
+        try:
+            count = store.load(customerid, year, name, records(), keys)
+        except Exception as exp:
+            failed += 1
+            echo("%s - error - %s" % (name, exp), FAIL)
+            continue
+        total += count
+        echo("%s - %d records (indexed: %s)" % (name, count, ", ".join(["id"] + list(keys))), PASS)
+    edfi.profile("index %s %s (count: %d)" % (customerid, year, total), time.time() - start)
+    if failed:
+        sys.exit(1)
+
+@cli.command()
+@click.argument("endpoint")
+@click.argument("customerid")
+@click.argument("year")
+@click.option("--where", "conditions", multiple=True, metavar="FIELD=VALUE", help="Only records with this value - may be repeated")
+@click.option("--fields", default=None, metavar="A,B,C", help="Only keep these fields of the records")
+@click.option("--limit", type=int, default=None, help="Most records to return")
+@click.option("--format", "fmt", type=click.Choice(["json", "ndjson"]), default="json", help="Write a json array or one record per line")
+@click.option("--output", default=None, type=click.File('w'), help="File to write the records to, defaults to stdout")
+def query(endpoint, customerid, year, conditions, fields, limit, fmt, output):
+    """
+    gets records from the local store (see index) - no api calls.  --where
+    fields are the endpoint's fields (key fields are indexed) or its column
+    names (schoolReference_schoolId)
+    """
+    start = time.time()
+    store = local_store()
+    projection = Projection([field.strip() for field in fields.split(",") if field.strip()]) if fields else None
+    writer = RecordWriter(output or click.get_text_stream('stdout'), fmt, json_indent(Config().config) if output else 4)
+    try:
+        batch = []
+        for record in store.query(customerid, year, endpoint, split_conditions(conditions), limit):
+            batch.append(record)
+            if len(batch) >= 1000:
+                writer.write(projection.project(batch) if projection else batch)
+                batch = []
+        writer.write(projection.project(batch) if projection else batch)
+        writer.close()
+    except Exception as exp:
+        echo("Could not query %s - %s" % (endpoint, exp), FAIL)
+        sys.exit(1)
+    if not writer.count:
+        echo("No records in %s match" % endpoint, INFO)
+        sys.exit(1)
+    if output:
+        echo("Wrote %d records from %s to %s in %.3fs" % (writer.count, endpoint, output.name, time.time() - start), PASS)
+    elif fmt == "json":
+        click.echo()
+
 @cli.command()
 @click.argument("customerid")
 @click.argument("year")
 def getendpoints(customerid, year):
     """ gets the endpoints for an edfi datasource """
-    edfi = EdFi(year=year, customer_id=customerid)
+    edfi = CommandServer.client(year, customerid)
 
     endpoints = edfi.get_endpoints()
     if not endpoints:
@@ -594,17 +3395,228 @@ def getendpoints(customerid, year):
 @cli.command()
 @click.argument("customerid")
 @click.argument("year")
-def checkendpoints(customerid, year):
-    """ checks endpoints for at least one record of data - if data is found, returnes true for that endpoint, else returns false"""
-    stats = {}
-    edfi = EdFi(year=year, customer_id=customerid)
+@click.option("--counts", is_flag=True, help="Add the number of records of each endpoint")
+def checkendpoints(customerid, year, counts):
+    """
+    checks endpoints for at least one record of data - if data is found, returnes true for that endpoint, else returns false.
+    The endpoints are checked concurrently by max_workers threads and written
+    out (as one json object) as each finishes.  With --counts each endpoint has
+    {"data", "count"} instead
+    """
+    start = time.time()
+    edfi = CommandServer.client(year, customerid)
+    endpoints = edfi.get_endpoints()
+
+    echo("{", PASS)
+    with ThreadPoolExecutor(max_workers=edfi.max_workers) as pool:
+        futures = {pool.submit(edfi.check_endpoint, endpoint, counts): endpoint for endpoint in endpoints}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                data, count = future.result()
+                value = {"data": data, "count": count} if counts else data
+            except AuthError:
+                raise
+            except Exception as exp:
+                value = {"data": False, "count": None, "error": str(exp)} if counts else False
+            echo("    %s: %s%s" % (json.dumps(futures[future]), json.dumps(value), "," if i < len(futures) - 1 else ""), PASS)
+    echo("}", PASS)
+    edfi.profile("checkendpoints (endpoints: %d)" % len(endpoints), time.time()-start)
+    edfi.profile_connections()
+
+@cli.command()
+@click.argument("customerid")
+@click.argument("year")
+@click.option("--endpoint", "endpoints", multiple=True, help="Endpoint to extract, may be repeated - defaults to all endpoints")
+@click.option("--output-dir", default=".", type=click.Path(file_okay=False), help="Folder to write <endpoint>.json files to")
+@click.option("--limit", type=int, default=100, help="Number of records per page")
+@click.option("--format", "fmt", type=click.Choice(RECORD_FORMATS), default="json", help="Write a json array, one record per line or rows flattened to the endpoint's structure")
+@click.option("--compress", default=None, type=click.Choice(["gzip", "zstd"]), help="Compress the files as they are written, adding .gz/.zst to their names (zstd needs zstandard)")
+def extract(customerid, year, endpoints, output_dir, limit, fmt, compress):
+    """ gets all records of all (or the given) endpoints in one run, one file per endpoint """
+    start = time.time()
+    check_compress(compress, fmt)
+    edfi = CommandServer.client(year, customerid)
+    endpoints = list(endpoints) or edfi.get_endpoints()
+    total, failed = run_extract(edfi, endpoints, output_dir, limit, fmt, compress=compress)
+
+    elapsed = time.time() - start
+    echo("Extracted {} records from {} endpoints in {:.1f}s ({:.0f} records/s)".format(
+        total, len(endpoints), elapsed, total / elapsed if elapsed else 0), FAIL if failed else PASS)
+    edfi.profile("extract %s %s (count: %d)" % (customerid, year, total), elapsed)
+    edfi.profile_connections()
+    if failed:
+        sys.exit(1)
+
+def run_extract(edfi, endpoints, output_dir, limit, fmt, prefix="", compress=None):
+    """
+    extracts the endpoints to <output_dir>/<endpoint>.<fmt> (compressed as
+    they are written with compress), echoing each endpoint (after prefix) as
+    it finishes - returns (records, endpoints failed)
+    """
+    start = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    writers = {}
+    total = 0
+    failed = 0
+    for endpoint, offset, records in edfi.iter_extract(endpoints, limit):
+        if offset is None:
+            # endpoint finished - records holds the error if there was one
+            writer = writers.pop(endpoint, None)
+            if writer:
+                writer.close()
+                outputs.pop(endpoint).close()
+            count = writer.count if writer else 0
+            total += count
+            if records:
+                failed += 1
+                echo("{}{} - error after {} records - {}".format(prefix, endpoint, count, records), FAIL)
+            else:
+                echo("{}{} - {} records".format(prefix, endpoint, count), PASS)
+            edfi.profile("extract %s%s (count: %d)" % (prefix, endpoint, count), time.time()-start)
+            continue
+        if endpoint not in writers:
+            filename = os.path.join(output_dir, "{}.{}".format(endpoint, fmt))
+            outputs[endpoint] = LazyOutput(compressed_name(filename, compress), compress)
+            writers[endpoint] = build_writer(edfi, endpoint, fmt, outputs[endpoint], indent=json_indent(edfi.cfg))
+        writers[endpoint].write(records)
+    return total, failed
 
-    for endpoint in edfi.get_endpoints():
+@cli.command()
+@click.option("--target", "targets", multiple=True, metavar="CUSTOMERID[:YEAR]", help="Customer (and year) to extract, may be repeated")
+@click.option("--all", "all_customers", is_flag=True, help="Extract every customer section of config.toml")
+@click.option("--year", default=None, help="Year for the targets without one, defaults to the customer's default_year")
+@click.option("--endpoint", "endpoints", multiple=True, help="Endpoint to extract, may be repeated - defaults to all endpoints")
+@click.option("--output-dir", default=".", type=click.Path(file_okay=False), help="Folder to write <customer>/<year>/<endpoint>.json files to")
+@click.option("--limit", type=int, default=100, help="Number of records per page")
+@click.option("--format", "fmt", type=click.Choice(RECORD_FORMATS), default="json", help="Write a json array, one record per line or rows flattened to the endpoint's structure")
+@click.option("--jobs", type=int, default=4, help="Number of customer/years extracted at once")
+@click.option("--compress", default=None, type=click.Choice(["gzip", "zstd"]), help="Compress the files as they are written, adding .gz/.zst to their names (zstd needs zstandard)")
+def fanout(targets, all_customers, year, endpoints, output_dir, limit, fmt, jobs, compress):
+    """
+    extracts several customers/years in one run - --jobs of them at a time,
+    each as the extract command does.  Customers on the same api host share
+    its host_concurrency and the years of a customer share one token
+    """
+    start = time.time()
+    check_compress(compress, fmt)
+    targets = FanOut.targets(Config().config, targets, all_customers, year)
+    if not targets:
+        raise click.UsageError("Give --target CUSTOMERID[:YEAR] or --all")
+    run = FanOut(targets)
+    try:
+        fanout_run(run, targets, endpoints, output_dir, limit, fmt, jobs, compress, start)
+    finally:
+        run.close()
+
+def fanout_run(run, targets, endpoints, output_dir, limit, fmt, jobs, compress, start):
+    """ extracts the targets of a FanOut - exits with 1 if any endpoint failed """
+    def job(target):
+        customer_id, target_year = target
+        edfi = run.instances[target]
+        prefix = "{}/{} ".format(customer_id, target_year)
         try:
-            stats[endpoint] = True if edfi.get(endpoint, 0, 1) else False
-        except:
-            stats[endpoint] = False
-    echo(json.dumps(stats, indent=4), PASS)
+            target_endpoints = list(endpoints) or edfi.get_endpoints()
+            return run_extract(edfi, target_endpoints, os.path.join(output_dir, customer_id, target_year), limit, fmt, prefix, compress)
+        except Exception as exp:
+            echo("{}- error - {}".format(prefix, exp), FAIL)
+            return 0, 1
+
+    total = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for target, (records, errors) in zip(targets, pool.map(job, targets)):
+            total += records
+            failed += errors
+            echo("{}/{} - {} records{}".format(target[0], target[1], records, " ({} endpoints failed)".format(errors) if errors else ""),
+                 FAIL if errors else PASS)
+
+    elapsed = time.time() - start
+    echo("Extracted {} records from {} customer/years in {:.1f}s ({:.0f} records/s)".format(
+        total, len(targets), elapsed, total / elapsed if elapsed else 0), FAIL if failed else PASS)
+    first = next(iter(run.instances.values()))
+    first.profile("fanout (targets: %d, count: %d)" % (len(targets), total), elapsed)
+    for edfi in {id(edfi.session): edfi for edfi in run.instances.values()}.values():
+        edfi.profile_connections() # once per customer, its years share the session
+    if failed:
+        sys.exit(1)
+
+@cli.command()
+@click.argument("customerid")
+@click.argument("year")
+@click.option("--endpoint", "endpoints", multiple=True, help="Endpoint to sync, may be repeated - defaults to all endpoints")
+@click.option("--output-dir", default=".", type=click.Path(file_okay=False), help="Folder to write the changes to")
+@click.option("--limit", type=int, default=100, help="Number of records per page")
+@click.option("--format", "fmt", type=click.Choice(["json", "ndjson"]), default="json", help="Write a json array or one record per line")
+@click.option("--compress", default=None, type=click.Choice(["gzip", "zstd"]), help="Compress the files as they are written, adding .gz/.zst to their names (zstd needs zstandard)")
+def sync(customerid, year, endpoints, output_dir, limit, fmt, compress):
+    """
+    gets the records changed since the last sync (3.x only) - writes
+    <endpoint>.<min>-<max>.json and <endpoint>.deletes.<min>-<max>.json
+    for each endpoint with changes, the first sync gets all records
+    """
+    start = time.time()
+    check_compress(compress, fmt)
+    edfi = CommandServer.client(year, customerid)
+    state = SyncState(edfi.general_setting('sync_state_file', 'sync_state.json'))
+    try:
+        oldest, newest = edfi.get_change_versions()
+    except Exception as exp:
+        echo("Could not get change versions for %s - %s" % (customerid, exp), FAIL)
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    total = 0
+    for endpoint in endpoints or edfi.get_endpoints():
+        synced = state.get(customerid, year, endpoint)
+        if synced is not None and synced >= newest:
+            echo("{} - up to date at change version {}".format(endpoint, synced), INFO)
+            continue
+        # the api only keeps the changes from oldest on - nothing older is asked for
+        min_version = oldest if synced is None else synced + 1
+        if synced is not None and oldest is not None and min_version < oldest:
+            echo("{} - changes before change version {} are no longer kept by the api, some may be missed".format(endpoint, oldest), INFO)
+            min_version = oldest
+        window = "{}-{}".format(0 if min_version is None else min_version, newest)
+        counts = {}
+        try:
+            # deletes only matter when there is a previous sync to apply them to
+            for deletes in ([False] if synced is None else [False, True]):
+                filename = os.path.join(output_dir, "{}{}.{}.{}".format(endpoint, ".deletes" if deletes else "", window, fmt))
+                output = LazyOutput(compressed_name(filename, compress), compress)
+                writer = RecordWriter(output, fmt, json_indent(edfi.cfg))
+                for offset, records in edfi.iter_changes(endpoint, min_version, newest, limit, deletes):
+                    writer.write(records)
+                writer.close()
+                output.close()
+                counts[deletes] = writer.count
+        except AuthError:
+            raise
+        except Exception as exp:
+            echo("{} - error - {}".format(endpoint, exp), FAIL)
+            continue
+        state.set(customerid, year, endpoint, newest)
+        total += sum(counts.values())
+        echo("{} - {} changed, {} deleted (change versions {})".format(endpoint, counts[False], counts.get(True, 0), window), PASS)
+    edfi.profile("sync %s %s (count: %d)" % (customerid, year, total), time.time()-start)
+    edfi.profile_connections()
+
+@cli.command()
+@click.option("--socket", "socket_path", default=SOCKET_PATH, help="Unix socket to listen on (EDFI_SOCKET)")
+def serve(socket_path):
+    """
+    runs until interrupted, keeping the EdFi clients (pooled connections,
+    tokens and parsed metadata) of the commands it is sent.  While it runs,
+    other calls of edfi.py forward their command to it instead of starting up
+    - set EDFI_NO_SERVER=1 to run a command in its own process
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise click.UsageError("serve needs unix sockets")
+    echo("Serving edfi commands on %s" % socket_path, INFO)
+    try:
+        CommandServer(socket_path).serve()
+    except KeyboardInterrupt:
+        pass
 
 @cli.command()
 def version():
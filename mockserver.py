@@ -0,0 +1,287 @@
+# #############################################################################
+# mock edfi server
+#
+# local stand-in for an EdFi ODS api, for benchmarks and trying changes without
+# credentials to a live instance.  Serves the 2.x and 3.x auth, paging,
+# metadata (api-docs/swagger), change queries and Total-Count - records are
+# generated from their offset so any number can be served without memory
+#
+# latency, jitter, 429/503 errors and early token expiry (401) can be added,
+# and responses gzipped for clients that accept it
+#
+# run python3 mockserver.py --help to see usage
+#
+# #############################################################################
+import gzip
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+import click
+
+DEFAULT_ENDPOINTS = {"students": 10000, "schools": 25, "staffs": 500, "calendarDates": 2000, "academicWeeks": 0}
+
+DELETE_EVERY = 97 # every 97th record of an endpoint is served from the deletes route
+
+class MockEdFi(ThreadingHTTPServer):
+    """
+    the server - endpoints maps an endpoint name to its number of records.
+    Settings and the request counters are shared by the handler threads
+    """
+    daemon_threads = True
+
+    def __init__(self, address, endpoints=None, latency=0.0, jitter=0.0, error_rate=0.0, token_ttl=0.0, expires_in=3600, seed=None, gzip=False):
+        """ inity stuff """
+        ThreadingHTTPServer.__init__(self, address, MockHandler)
+        self.gzip = gzip
+        self.endpoints = dict(endpoints if endpoints is not None else DEFAULT_ENDPOINTS)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.expires_in = expires_in
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.tokens = {}
+        self.stats = {}
+
+    @property
+    def url(self):
+        """ base url to put in edfi_base_url """
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def count(self, name):
+        """ counts a request """
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def reset(self):
+        """ returns the request counters and starts new ones """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def issue_token(self):
+        """ a new token - expires after token_ttl seconds if set, whatever expires_in says """
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time()
+        return {"access_token": token, "expires_in": self.expires_in, "token_type": "bearer"}
+
+    def authorized(self, header):
+        """ true if the Authorization header has a token that has not expired """
+        if not header or not header.startswith("Bearer "):
+            return False
+        issued = self.tokens.get(header[len("Bearer "):])
+        if issued is None:
+            return False
+        return not self.token_ttl or time.time() - issued < self.token_ttl
+
+    def delay(self):
+        """ waits the latency plus up to jitter more """
+        wait = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def fail(self):
+        """ true if this request should get an injected error """
+        return self.error_rate and self.random.random() < self.error_rate
+
+def record(endpoint, i):
+    """ the record at index i of an endpoint - the change version is i + 1 """
+    return {
+        "id": "{}-{:08d}".format(endpoint, i),
+        "schoolId": 100 + i % 5,
+        "name": "{} {}".format(endpoint, i),
+        "beginDate": "2018-08-{:02d}".format(1 + i % 28),
+        "schoolReference": {"schoolId": 100 + i % 5, "link": {"rel": "School", "href": "/schools/{}".format(100 + i % 5)}},
+    }
+
+PROPERTIES_2X = {
+    "id": {"type": "string"},
+    "schoolId": {"type": "integer"},
+    "name": {"type": "string"},
+    "beginDate": {"type": "date-time"},
+    "schoolReference": {"type": "schoolReference"},
+}
+
+def api_docs_2x(endpoint):
+    """ the 2.x api-docs of an endpoint """
+    return {
+        "apis": [{"path": "/" + endpoint, "operations": [{"nickname": "get{}All".format(endpoint), "items": {"$ref": endpoint}}]}],
+        "models": {
+            endpoint: {"properties": PROPERTIES_2X},
+            "schoolReference": {"properties": {"schoolId": {"type": "integer"}, "link": {"type": "link"}}},
+            "link": {"properties": {"rel": {"type": "string"}, "href": {"type": "string"}}},
+        },
+    }
+
+def swagger_3x(endpoints):
+    """ the 3.x swagger document of the endpoints """
+    definitions = {
+        "edFi_schoolReference": {"properties": {"schoolId": {"type": "integer"}, "link": {"$ref": "#/definitions/link"}}},
+        "link": {"properties": {"rel": {"type": "string"}, "href": {"type": "string"}}},
+    }
+    for endpoint in endpoints:
+        definitions["edFi_" + endpoint] = {"properties": {
+            "id": {"type": "string"},
+            "schoolId": {"type": "integer"},
+            "name": {"type": "string"},
+            "beginDate": {"type": "string", "format": "date-time"},
+            "schoolReference": {"$ref": "#/definitions/edFi_schoolReference"},
+            "_etag": {"type": "string"},
+        }}
+    return {"swagger": "2.0", "paths": {"/ed-fi/{}".format(e): {} for e in endpoints}, "definitions": definitions}
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ routes the 2.x and 3.x requests """
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1 # headers and body go out together, flushed after each request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, headers=None):
+        """ sends a json response """
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        if self.server.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content, 6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        """ auth - 2.x authorize/token and 3.x client credentials token """
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        self.server.count("auth")
+        if path == "/api/oauth/authorize":
+            return self.send(200, {"code": uuid.uuid4().hex})
+        if path == "/oauth/token":
+            return self.send(200, self.server.issue_token())
+        if path == "/api/oauth/token":
+            if not self.headers.get("Authorization", "").startswith("Basic "):
+                return self.send(401, {"error": "invalid_client"})
+            return self.send(200, self.server.issue_token())
+        return self.send(404, {"message": "not found"})
+
+    def do_GET(self):
+        """ metadata and data """
+        server = self.server
+        parsed = urlparse(self.path)
+        parts = parsed.path.strip("/").split("/")
+        query = parse_qs(parsed.query)
+
+        if parsed.path == "/metadata/resources/api-docs":
+            server.count("metadata")
+            return self.send(200, {"apis": [{"path": "/" + e} for e in server.endpoints]})
+        if parsed.path.startswith("/metadata/resources/api-docs/"):
+            server.count("metadata")
+            if parts[-1] not in server.endpoints:
+                return self.send(404, {"message": "not found"})
+            return self.send(200, api_docs_2x(parts[-1]))
+        if parsed.path == "/api/metadata/data/v3/resources/swagger.json":
+            server.count("metadata")
+            etag = '"{}"'.format(len(server.endpoints))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            return self.send(200, swagger_3x(server.endpoints), {"ETag": etag})
+
+        if not server.authorized(self.headers.get("Authorization")):
+            server.count("unauthorized")
+            return self.send(401, {"message": "Authorization has been denied for this request."})
+        server.delay()
+        if server.fail():
+            server.count("errors")
+            return self.send(server.random.choice([429, 503]), {"message": "busy"}, {"Retry-After": "0"})
+
+        if parsed.path == "/api/changeQueries/v1/availableChangeVersions":
+            server.count("data")
+            return self.send(200, {"OldestChangeVersion": 0, "NewestChangeVersion": max(list(server.endpoints.values()) + [0])})
+
+        # 3.x: api/data/v3/ed-fi/<endpoint>[/deletes|/<id>], 2.x: api/<ver>/<year>/<endpoint>[/<id>]
+        if parts[:4] == ["api", "data", "v3", "ed-fi"]:
+            route = parts[4:]
+        elif len(parts) >= 4 and parts[0] == "api":
+            route = parts[3:]
+        else:
+            return self.send(404, {"message": "not found"})
+        if not route or route[0] not in server.endpoints:
+            return self.send(404, {"message": "not found"})
+        server.count("data")
+        endpoint, total = route[0], server.endpoints[route[0]]
+
+        if len(route) > 1 and route[1] != "deletes":
+            i = route[1].rsplit("-", 1)[-1]
+            if route[1].startswith(endpoint + "-") and i.isdigit() and int(i) < total:
+                return self.send(200, record(endpoint, int(i)))
+            return self.send(404, {"message": "not found"})
+
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["25"])[0])
+        indexes = range(0, total, DELETE_EVERY) if route[1:] == ["deletes"] else range(total)
+        if "minChangeVersion" in query or "maxChangeVersion" in query:
+            low = int(query.get("minChangeVersion", ["0"])[0])
+            high = int(query.get("maxChangeVersion", [str(total)])[0])
+            first = -(-max(0, low - 1) // indexes.step) * indexes.step # first index in the range with change version >= low
+            indexes = range(first, min(indexes.stop, high), indexes.step)
+        filters = {k: v[0] for k, v in query.items() if k not in ("offset", "limit", "totalCount", "minChangeVersion", "maxChangeVersion")}
+        if filters:
+            data = [r for r in (record(endpoint, i) for i in indexes) if all(str(r.get(k)) == v for k, v in filters.items())][offset:offset + limit]
+        else:
+            data = [record(endpoint, i) for i in indexes[offset:offset + limit]]
+        headers = {"Total-Count": str(len(indexes))} if query.get("totalCount") == ["true"] and not filters else {}
+        return self.send(200, data, headers)
+
+def start(port=0, **settings):
+    """ starts a server on a background thread - port 0 picks a free port """
+    server = MockEdFi(("127.0.0.1", port), **settings)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def parse_endpoints(values):
+    """ endpoint=count options to a dict - the defaults if none given """
+    if not values:
+        return None
+    endpoints = {}
+    for value in values:
+        name, _, count = value.partition("=")
+        endpoints[name] = int(count or 0)
+    return endpoints
+
+@click.command()
+@click.option("--port", default=8765, help="port to listen on")
+@click.option("--endpoint", "endpoints", multiple=True, help="endpoint=records to serve, repeat for more (default: %s)" % ", ".join("%s=%d" % x for x in DEFAULT_ENDPOINTS.items()))
+@click.option("--latency", default=0.0, help="seconds added to each data request")
+@click.option("--jitter", default=0.0, help="up to this many more seconds added at random")
+@click.option("--error-rate", default=0.0, help="fraction of data requests answered with a 429 or 503")
+@click.option("--token-ttl", default=0.0, help="seconds after which tokens are refused (401) - 0 never")
+@click.option("--seed", default=None, type=int, help="seed for the jitter and errors")
+@click.option("--gzip", "use_gzip", is_flag=True, help="gzip responses to clients that accept it")
+def serve(port, endpoints, latency, jitter, error_rate, token_ttl, seed, use_gzip):
+    """ serves a mock edfi api (2.x and 3.x) until interrupted """
+    server = MockEdFi(("127.0.0.1", port), parse_endpoints(endpoints), latency, jitter, error_rate, token_ttl, seed=seed, gzip=use_gzip)
+    click.echo("Serving mock edfi api on %s - %s" % (server.url, ", ".join("%s=%d" % x for x in server.endpoints.items())))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo(json.dumps(server.reset()))
+
+
+if __name__ == '__main__':
+    serve()
@@ -1,10 +1,104 @@
 import csv
 import json
+import math
 from urllib.parse import urlparse, parse_qs
 
-import arrow
 import click
 
+class QuantileSketch(object):
+    """
+    Log bucketed quantile sketch (as in DDSketch) - values are counted in
+    buckets that grow by a factor of gamma, so a quantile is within
+    relative_accuracy of the true value and the memory used only depends on
+    the range of the values, not on how many there are
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        """ adds a value """
+        self.count += 1
+        self.max = max(self.max, value)
+        if value <= 1e-9:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def quantile(self, q):
+        """ returns the estimated value at quantile q (0-1) """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return min(round(2 * self.gamma ** key / (self.gamma + 1), 6), self.max)
+        return self.max
+
+def resource(path):
+    """
+    (endpoint, kind) of a data url path - /api/data/v3/<schema>/<endpoint> or
+    /api/<version>/<year>/<endpoint>, kind being "" for pages, "id" for a
+    record by id and "deletes".  None for metadata and the other urls
+    """
+    parts = [part for part in path.split("/") if part]
+    rest = None
+    for i, part in enumerate(parts):
+        if part == "data" and parts[i - 1:i] == ["api"] and parts[i + 1:i + 2] == ["v3"]:
+            rest = parts[i + 3:]
+            if parts[i + 2:i + 3] and parts[i + 2].isdigit():
+                rest = rest[1:] # year specific instance - /data/v3/<year>/<schema>
+        elif part == "api" and i + 1 < len(parts) and parts[i + 1].startswith("v2"):
+            rest = parts[i + 3:]
+        if rest is not None:
+            break
+    if not rest:
+        return None
+    kind = ""
+    if len(rest) > 1:
+        kind = "deletes" if rest[1] == "deletes" else "id"
+    return rest[0], kind
+
+class Timeline(object):
+    """
+    Requests and records per second, written to csv as it goes - a second is
+    written once the log is lag seconds past it.  Lines that arrive later than
+    that are written as their own row
+    """
+    def __init__(self, writer, lag=5):
+        self.writer = writer
+        self.lag = lag
+        self.seconds = {}
+        self.latest = None
+        self.writer.writerow(["second", "requests", "records", "duration"])
+
+    def add(self, second, records, duration):
+        """ counts a request - second is the 'YYYY-MM-DD HH:MM:SS' of the entry """
+        row = self.seconds.get(second)
+        if row is None:
+            row = self.seconds[second] = [0, 0, 0.0]
+        row[0] += 1
+        row[1] += records or 0
+        row[2] += duration
+        if self.latest is None or second > self.latest:
+            self.latest = second
+            self.flush(keep=self.lag)
+
+    def flush(self, keep=0):
+        """ writes the seconds older than the last keep seconds seen """
+        for second in sorted(self.seconds)[:max(0, len(self.seconds) - keep)]:
+            row = self.seconds.pop(second)
+            self.writer.writerow([second, row[0], row[1], round(row[2], 6)])
+
 @click.group()
 def cli():
     """ to csv stuffs """
@@ -13,52 +107,72 @@ def cli():
 @cli.command()
 @click.argument("log", type=click.File())
 def convert(log):
-    """ converts profile log file to csv """
-    
-    entries = []
-    summaries = []
-    for line in log.readlines():
-        data = json.loads(line)
-
-        if data['message'].startswith("GET"):
-            # "2018-11-29 14:08:38,749",0.234741,GET https://edfi-mich-test-web.southcentralus.cloudapp.azure.com/v2.4.0/api/api/v2.0/2018/calendarDates?offset=50&limit=50
-            pr = urlparse(data['message'].split(" ")[1])
-            data['endpoint'] = pr.path.split("/")[-1]
-            data['offset'] = int(parse_qs(pr.query)['offset'][0])
-            data.pop("message")
-            entries.append(data)
-        # elif data['message'].startswith("get"): # summaries
-        #     # example: get disciplineActions (count: 8168)
-        #     parts = data['message'].split()
-        #     row = {"endpoint": parts[1], 'count':parts[-1][0:-1], 'duration':data['duration']}
-        #     summaries.append(row)
+    """
+    converts profile log file to csv - in one pass with constant memory:
+    <log>-entries.csv has a row per GET, <log>profile-summaries.csv the
+    requests, records and p50/p90/p99 latency per endpoint and
+    <log>-timeline.csv the requests and records per second.  Only data urls
+    are counted, records by id and deletes summarized apart from the pages
+    """
+    basename = log.name.split(".")[0]
+    summaries = {}
+    skipped = 0
+    with open(basename + "-entries.csv", 'w', newline='') as entries_file, \
+            open(basename + "-timeline.csv", 'w', newline='') as timeline_file:
+        entries = csv.writer(entries_file)
+        entries.writerow(["datetime", "duration", "endpoint", "kind", "offset", "records", "bytes", "wire_bytes", "ttfb", "decode", "retries", "queue_wait"])
+        timeline = Timeline(csv.writer(timeline_file))
 
-    if not summaries:    
-        _summary_dict = {}
-        for entry in entries:    
-            if not entry['endpoint'] in _summary_dict:
-                _summary_dict[entry['endpoint']] = {"duration": 0, "count": 0, 'start':arrow.get(0), 'stop':arrow.get(0)}
-            _summary_dict[entry['endpoint']]['duration'] += entry['duration']
-            _summary_dict[entry['endpoint']]['count'] = max(_summary_dict[entry['endpoint']]['count'], entry['offset'])
-            endpoint_time = arrow.get(entry['datetime'])
+        for line in log:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not data['message'].startswith("GET"):
+                continue
+            # "2018-11-29 14:08:38,749",0.234741,GET https://edfi-mich-test-web.southcentralus.cloudapp.azure.com/v2.4.0/api/api/v2.0/2018/calendarDates?offset=50&limit=50 (records: 50)
+            parts = data['message'].split(" ")
+            pr = urlparse(parts[1])
+            key = resource(pr.path)
+            if key is None:
+                continue # metadata, change versions
+            endpoint, kind = key
+            offset = parse_qs(pr.query).get('offset', [None])[0]
+            offset = int(offset) if offset is not None else None
+            records = int(parts[3][:-1]) if len(parts) > 3 and parts[2] == "(records:" else None
+            duration = data['duration']
+            entries.writerow([data['datetime'], duration, endpoint, kind, offset, records] + [data.get(f) for f in ("bytes", "wire_bytes", "ttfb", "decode", "retries", "queue_wait")])
+            timeline.add(data['datetime'][:19], records, duration)
 
-        
-        for endpoint, val in _summary_dict.items():
-            row = {"endpoint": endpoint}
-            row.update(val)
-            summaries.append(row)
+            # a row per endpoint and kind - records by id and deletes are not mixed in with the pages
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = {"duration": 0, "count": 0, "requests": 0, "records": 0, "bytes": 0, "wire_bytes": 0,
+                                                 "start": data['datetime'], "stop": data['datetime'], "latency": QuantileSketch()}
+            summary['duration'] += duration
+            summary['count'] = max(summary['count'], offset or 0)
+            summary['requests'] += 1
+            summary['records'] += records or 0
+            summary['bytes'] += data.get('bytes') or 0
+            summary['wire_bytes'] += data.get('wire_bytes', data.get('bytes')) or 0
+            summary['start'] = min(summary['start'], data['datetime'])
+            summary['stop'] = max(summary['stop'], data['datetime'])
+            summary['latency'].add(duration)
+        timeline.flush()
 
-    basename = log.name.split(".")[0]
-    with open(basename + "-entries.csv", 'w') as c:
-         writer = csv.DictWriter(c, [str(x) for x in entries[0].keys()])
-         writer.writeheader()
-         writer.writerows(entries)
     if summaries:
-        with open(basename + "profile-summaries.csv", 'w') as c:
-            writer = csv.DictWriter(c, [str(x) for x in summaries[0].keys()])
-            writer.writeheader()
-            writer.writerows(summaries)
+        with open(basename + "profile-summaries.csv", 'w', newline='') as c:
+            writer = csv.writer(c)
+            writer.writerow(["endpoint", "kind", "duration", "count", "requests", "records", "bytes", "wire_bytes", "p50", "p90", "p99", "max", "start", "stop"])
+            for (endpoint, kind), summary in summaries.items():
+                latency = summary['latency']
+                writer.writerow([endpoint, kind, round(summary['duration'], 6), summary['count'], summary['requests'], summary['records'],
+                                 summary['bytes'], summary['wire_bytes'], latency.quantile(0.5), latency.quantile(0.9), latency.quantile(0.99), latency.max,
+                                 summary['start'], summary['stop']])
+    if skipped:
+        click.echo("Skipped %d lines that were not json" % skipped)
 
 
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    cli()